@@ -0,0 +1,89 @@
+#!/usr/bin/env python3
+# Mede quanta memória cada conexão ociosa do servidor IRC ocupa.
+#
+# Não usa a camada física nem a de rede: os segmentos dos clientes são
+# entregues direto ao Servidor do tcp.py, e os segmentos enviados por ele
+# são só lidos para responder com os ACKs. Cada cliente faz o handshake,
+# registra um apelido com NICK, reconhece as respostas do servidor e fica
+# parado. A memória é medida com o tracemalloc.
+#
+# Uso: ./benchmark_conexoes.py [numero_de_conexoes]
+
+import asyncio
+import gc
+import sys
+import tracemalloc
+from tcputils import make_header, read_header, FLAGS_SYN, FLAGS_ACK
+from tcp import Servidor
+import servidor as irc
+
+PORTA = 6667
+ENDERECO_SERVIDOR = 0xc0a8c804  # 192.168.200.4
+
+
+class RedeFalsa:
+    ignore_checksum = True
+
+    def __init__(self):
+        self.callback = None
+        self.enviados = []
+
+    def registrar_recebedor(self, callback):
+        self.callback = callback
+
+    def enviar(self, segmento, dest_addr):
+        self.enviados.append(segmento)
+
+
+def conectar(rede, endereco, porta_cliente):
+    """
+    Abre uma conexão como um cliente IRC que manda NICK e fica ocioso.
+    """
+    def entregar(seq, ack, flags, dados=b''):
+        segmento = make_header(porta_cliente, PORTA, seq, ack, flags) + dados
+        rede.callback(endereco, ENDERECO_SERVIDOR, segmento)
+
+    seq = 1000
+    entregar(seq, 0, FLAGS_SYN)
+    seq += 1
+    ack = read_header(rede.enviados.pop())[2] + 1
+    entregar(seq, ack, FLAGS_ACK)
+
+    nick = b'NICK u%d\r\n' % porta_cliente
+    entregar(seq, ack, FLAGS_ACK, nick)
+    seq += len(nick)
+    # Reconhece tudo o que o servidor respondeu
+    for segmento in rede.enviados:
+        _, _, seq_servidor, _, flags, _, _, _ = read_header(segmento)
+        ack = max(ack, seq_servidor + len(segmento) - 4*(flags >> 12))
+    rede.enviados.clear()
+    entregar(seq, ack, FLAGS_ACK)
+
+
+async def main(n):
+    rede = RedeFalsa()
+    servidor = Servidor(rede, PORTA, max_conexoes=n)
+    servidor.registrar_monitor_de_conexoes_aceitas(irc.conexao_aceita)
+    # O servidor IRC imprime cada conexão aceita
+    irc.print = lambda *args: None
+
+    gc.collect()
+    tracemalloc.start()
+    antes = tracemalloc.get_traced_memory()[0]
+    for i in range(n):
+        endereco = 0x0a000000 + (i >> 15)
+        conectar(rede, endereco, 1024 + (i & 0x7fff))
+    # Deixa passar o atraso dos ACKs
+    await asyncio.sleep(0.1)
+    gc.collect()
+    depois = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+
+    assert len(servidor.conexoes) == n
+    print('%d conexões ociosas: %.1f MiB, %d bytes por conexão' %
+          (n, (depois - antes) / 2**20, (depois - antes) // n))
+
+
+if __name__ == '__main__':
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 10000
+    asyncio.run(main(n))
@@ -0,0 +1,141 @@
+# Leitura e escrita dos cabeçalhos IPv4, TCP e ICMP com objetos
+# struct.Struct pré-compilados.
+#
+# struct.pack e struct.unpack com uma string de formato precisam achar (num
+# cache) o formato compilado a cada chamada; um Struct já compilado pula
+# essa etapa. Além disso, pack_into escreve direto em um buffer já alocado,
+# e unpack_from lê de qualquer posição de bytes, bytearray ou memoryview
+# sem fatiar (copiar) o pacote antes.
+#
+# Os formatos são os mesmos de tcputils e iputils, então os bytes gerados e
+# os valores lidos são idênticos aos daqueles módulos, que continuam como
+# estão.
+#
+# Aqui também fica o Pacote, o buffer com espaço livre na frente e atrás
+# em que um segmento desce pela pilha: o TCP monta o segmento, o IP escreve
+# o seu cabeçalho logo antes dele e o SLIP põe os ENDs nas pontas, tudo no
+# mesmo bytearray.
+
+import struct
+
+IPV4 = struct.Struct('!BBHHHBBHII')
+TCP = struct.Struct('!HHIIHHHH')
+ICMP = struct.Struct('!BBHI')
+
+# Pedaços menores, para ler ou alterar campos isolados
+PALAVRA = struct.Struct('!H')
+DUAS_PALAVRAS = struct.Struct('!HH')
+PALAVRA_DUPLA = struct.Struct('!I')
+PAR = struct.Struct('!II')
+OPCAO_TS = struct.Struct('!BBBBII')
+
+TAMANHO_IPV4 = IPV4.size
+TAMANHO_TCP = TCP.size
+
+# Posição do checksum em cada cabeçalho
+CHECKSUM_IPV4 = 10
+CHECKSUM_TCP = 16
+
+# Espaço reservado na frente de um segmento para as camadas de baixo (o
+# cabeçalho IPv4 sem opções e o END do SLIP) e atrás dele (o END final)
+FOLGA_FRENTE = TAMANHO_IPV4 + 1
+FOLGA_TRAS = 1
+
+
+class Pacote:
+    """
+    Pacote guardado em buffer[inicio:fim], com espaço livre antes e depois.
+    Cada camada escreve o seu cabeçalho no espaço livre da frente (vide
+    prefixar), sem copiar o que as camadas de cima já montaram.
+    """
+    __slots__ = ('buffer', 'inicio', 'fim')
+
+    def __init__(self, buffer, inicio, fim):
+        self.buffer = buffer
+        self.inicio = inicio
+        self.fim = fim
+
+    @classmethod
+    def novo(cls, tamanho, frente=FOLGA_FRENTE, tras=FOLGA_TRAS):
+        """
+        Aloca um pacote de tamanho bytes (zerados), com as folgas dadas.
+        """
+        return cls(bytearray(frente + tamanho + tras), frente, frente + tamanho)
+
+    @classmethod
+    def de(cls, dados, frente=FOLGA_FRENTE, tras=FOLGA_TRAS):
+        """
+        Copia dados (bytes, bytearray ou memoryview) para um pacote novo.
+        """
+        pacote = cls.novo(len(dados), frente, tras)
+        pacote.buffer[pacote.inicio:pacote.fim] = dados
+        return pacote
+
+    def __len__(self):
+        return self.fim - self.inicio
+
+    def __bytes__(self):
+        return bytes(self.buffer[self.inicio:self.fim])
+
+    def dados(self):
+        """
+        memoryview (gravável) do conteúdo do pacote, sem as folgas.
+        """
+        return memoryview(self.buffer)[self.inicio:self.fim]
+
+    def prefixar(self, tamanho):
+        """
+        Devolve um Pacote no mesmo buffer que começa tamanho bytes antes
+        deste, para a camada de baixo escrever ali o seu cabeçalho. Este
+        pacote não muda, então a camada de cima pode reenviá-lo depois. Só
+        copia os dados se a folga da frente não for suficiente.
+        """
+        if self.inicio < tamanho:
+            return Pacote.de(self.dados(), tamanho + FOLGA_FRENTE).prefixar(tamanho)
+        return Pacote(self.buffer, self.inicio - tamanho, self.fim)
+
+    def sufixar(self, tamanho):
+        """
+        Como prefixar, mas estende o pacote tamanho bytes para trás.
+        """
+        if len(self.buffer) - self.fim < tamanho:
+            pacote = Pacote.de(self.dados(), FOLGA_FRENTE, tamanho)
+            return Pacote(pacote.buffer, pacote.inicio, pacote.fim + tamanho)
+        return Pacote(self.buffer, self.inicio, self.fim + tamanho)
+
+
+def ler_ipv4(datagrama, inicio=0):
+    """
+    Lê o cabeçalho IPv4 (sem opções) que começa em datagrama[inicio],
+    devolvendo (vihl, dscpecn, total_len, identification, flagsfrag, ttl,
+    proto, checksum, src_addr, dst_addr), com os endereços como inteiros.
+    """
+    return IPV4.unpack_from(datagrama, inicio)
+
+
+def ler_tcp(segmento, inicio=0):
+    """
+    Lê o cabeçalho TCP que começa em segmento[inicio], devolvendo a mesma
+    tupla que tcputils.read_header.
+    """
+    return TCP.unpack_from(segmento, inicio)
+
+
+def novo_segmento(src_port, dst_port, seq_no, ack_no, flags, janela,
+                  opcoes=b'', dados=b''):
+    """
+    Monta um segmento TCP inteiro (cabeçalho, opções já alinhadas e dados)
+    em um Pacote alocado de uma vez, com o checksum zerado e com folga para
+    os cabeçalhos das camadas de baixo.
+    """
+    tamanho_cabecalho = TAMANHO_TCP + len(opcoes)
+    segmento = Pacote.novo(tamanho_cabecalho + len(dados))
+    buffer, inicio = segmento.buffer, segmento.inicio
+    TCP.pack_into(buffer, inicio, src_port, dst_port, seq_no, ack_no,
+                  ((tamanho_cabecalho // 4) << 12) | flags,
+                  min(janela, 0xffff), 0, 0)
+    if opcoes:
+        buffer[inicio + TAMANHO_TCP:inicio + tamanho_cabecalho] = opcoes
+    if dados:
+        buffer[inicio + tamanho_cabecalho:segmento.fim] = dados
+    return segmento
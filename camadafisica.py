@@ -2,11 +2,16 @@ import os
 import mmap
 import errno
 import fcntl
-import struct
 import termios
 import asyncio
 import traceback
-from collections import defaultdict
+
+
+NUM_PORTAS = 8
+
+
+def _descartar(dados):
+    pass
 
 
 class ZyboSerialDriver:
@@ -16,9 +21,16 @@ class ZyboSerialDriver:
         self.fd = os.open(device, os.O_RDWR)
         fcntl.fcntl(self.fd, fcntl.F_SETFL, os.O_NONBLOCK)
         self.mm = mmap.mmap(self.fd, 0x1000)
+        # Vê os registradores como palavras de 32 bits: escrever em
+        # self.regs[port] enfileira um byte para transmissão na porta, e ler
+        # self.fila_rx[0] retira um elemento da fila de recepção (-1 se vazia).
+        # Assim cada acesso é uma única operação, sem struct.pack/unpack.
+        self.regs = memoryview(self.mm).cast('I')
+        self.fila_rx = memoryview(self.mm).cast('i')
         asyncio.get_event_loop().add_reader(self.fd, self.__irq_handler)
         self.__irq_unmask()
-        self.callbacks = defaultdict(lambda: lambda _: None)
+        self.callbacks = [_descartar] * NUM_PORTAS
+        self.buffers = [bytearray() for _ in range(NUM_PORTAS)]
 
     def obter_porta(self, port):
         """ Obtém uma porta para controlar a partir do software em Python """
@@ -33,26 +45,30 @@ class ZyboSerialDriver:
 
     def enviar(self, port, data):
         #print('send', port, data)
+        regs = self.regs
         for b in data:
-            self.mm[port*4:port*4+4] = struct.pack('I', b)
+            regs[port] = b
 
     def registrar_recebedor(self, port, callback):
         self.callbacks[port] = callback
 
     def __irq_handler(self):
         os.read(self.fd, 4)   # diz ao SO que coletamos a irq
-        buffers = defaultdict(lambda: bytearray())
+        fila_rx = self.fila_rx
+        buffers = self.buffers
         while True:
-            elem, = struct.unpack('i', self.mm[0:4])  # retira da fila do hardware
+            elem = fila_rx[0]                         # retira da fila do hardware
             if elem == -1: break                      # fila vazia
-            port, b = elem>>8, elem&0xff
-            buffers[port].append(b)
-        for port, dados in buffers.items():
+            buffers[elem>>8].append(elem&0xff)
+        for port, dados in enumerate(buffers):
+            if not dados:
+                continue
             try:
                 #print('recv', port, dados)
                 self.callbacks[port](bytes(dados))
             except:
                 traceback.print_exc()
+            dados.clear()
         self.__irq_unmask()
 
     def __irq_unmask(self):
@@ -60,6 +76,8 @@ class ZyboSerialDriver:
 
 
 class ZyboSerialPort:
+    envio_sincrono = True
+
     def __init__(self, driver, port):
         self.driver = driver
         self.port = port
@@ -76,6 +94,8 @@ class ZyboSerialPort:
 
 
 class PTY:
+    envio_sincrono = True
+
     def __init__(self):
         pty, slave_fd = os.openpty()
         iflag, oflag, cflag, lflag, ispeed, ospeed, cc = termios.tcgetattr(pty)
@@ -0,0 +1,240 @@
+# Algoritmos de controle de congestionamento para o TCP de tcp.py.
+#
+# Cada Conexao cria o seu próprio controlador (a classe é escolhida no
+# Servidor) e o avisa dos eventos do transmissor pelos métodos on_*. O
+# controlador só mantém cwnd e ssthresh (em bytes); quem decide o que
+# retransmitir continua sendo a Conexao.
+
+import time
+from tcputils import MSS
+
+
+class ControleCongestionamento:
+    """
+    Base dos controladores, com o comportamento do NewReno: slow start e
+    congestion avoidance da RFC 5681, com a recuperação rápida da RFC 6582.
+    Os outros controladores sobrescrevem os métodos em que diferem.
+    """
+    __slots__ = ('mss', 'cwnd', 'ssthresh', 'bytes_acumulados')
+
+    def __init__(self, mss=MSS):
+        self.mss = mss
+        self.cwnd = float(mss)
+        self.ssthresh = float(65535)
+        self.bytes_acumulados = 0.0
+
+    def _aumentar(self, bytes_reconhecidos):
+        """
+        Slow start com contagem de bytes (RFC 3465, L=2*MSS).
+        """
+        self.cwnd += min(bytes_reconhecidos, 2.0 * self.mss)
+
+    def on_ack(self, bytes_reconhecidos, rtt=None):
+        """
+        Chamado para cada ACK que reconhece dados novos fora da recuperação
+        rápida. rtt é a amostra de RTT (em segundos) obtida com esse ACK,
+        ou None se não houver.
+        """
+        if self.cwnd < self.ssthresh:
+            self._aumentar(bytes_reconhecidos)
+            return
+        # Congestion avoidance: aumenta 1 MSS a cada janela reconhecida
+        self.bytes_acumulados += bytes_reconhecidos
+        if self.bytes_acumulados >= self.cwnd:
+            self.bytes_acumulados -= self.cwnd
+            self.cwnd += self.mss
+
+    def on_loss(self, bytes_em_voo):
+        """
+        Chamado no terceiro ACK duplicado, ao entrar em recuperação rápida.
+        """
+        self.ssthresh = max(bytes_em_voo / 2.0, 2.0 * self.mss)
+        self.cwnd = self.ssthresh + 3.0 * self.mss
+        self.bytes_acumulados = 0.0
+
+    def on_dup_ack(self):
+        """
+        Chamado para cada ACK duplicado adicional durante a recuperação
+        rápida: cada um indica que mais um segmento saiu da rede.
+        """
+        self.cwnd += self.mss
+
+    def on_partial_ack(self, bytes_reconhecidos):
+        """
+        Chamado para um ACK parcial durante a recuperação rápida.
+        """
+        self.cwnd = max(self.cwnd - bytes_reconhecidos + self.mss,
+                        float(self.mss))
+
+    def on_recovery_exit(self, bytes_em_voo):
+        """
+        Chamado quando um ACK cobre todos os dados enviados até a perda.
+        Desinfla a janela, que foi inflada pelos ACKs duplicados.
+        """
+        self.cwnd = min(self.ssthresh, max(bytes_em_voo, float(self.mss)) + self.mss)
+
+    def on_timeout(self, bytes_em_voo):
+        """
+        Chamado quando o temporizador de retransmissão expira.
+        """
+        self.ssthresh = max(bytes_em_voo / 2.0, 2.0 * self.mss)
+        self.cwnd = float(self.mss)
+        self.bytes_acumulados = 0.0
+
+
+class NewReno(ControleCongestionamento):
+    """
+    Slow start e congestion avoidance da RFC 5681, com a recuperação rápida
+    da RFC 6582 (o comportamento da base, com um nome para o Servidor).
+    """
+    __slots__ = ()
+
+
+class Cubic(ControleCongestionamento):
+    """
+    CUBIC (RFC 8312). Depois de uma perda, a janela cresce seguindo uma
+    função cúbica do tempo desde a perda, centrada na janela em que a perda
+    aconteceu, o que a torna pouco sensível ao RTT em caminhos de alto BDP.
+    """
+    __slots__ = ('w_max', 'k', 'inicio_epoca', 'w_est', 'rtt_min')
+
+    C = 0.4
+    BETA = 0.7
+
+    def __init__(self, mss=MSS):
+        super().__init__(mss)
+        self.w_max = 0.0
+        self.k = 0.0
+        self.inicio_epoca = None
+        self.w_est = 0.0
+        self.rtt_min = None
+
+    def on_ack(self, bytes_reconhecidos, rtt=None):
+        if rtt is not None and (self.rtt_min is None or rtt < self.rtt_min):
+            self.rtt_min = rtt
+        if self.cwnd < self.ssthresh:
+            self._aumentar(bytes_reconhecidos)
+            return
+        agora = time.monotonic()
+        mss = self.mss
+        if self.inicio_epoca is None:
+            self.inicio_epoca = agora
+            if self.w_max <= self.cwnd:
+                self.w_max = self.cwnd
+                self.k = 0.0
+            else:
+                self.k = ((self.w_max - self.cwnd) / mss / self.C) ** (1 / 3)
+            self.w_est = self.cwnd
+        rtt_min = self.rtt_min or 0.0
+        t = agora - self.inicio_epoca + rtt_min
+        alvo = (self.C * (t - self.k) ** 3) * mss + self.w_max
+        # Região "TCP-friendly": não cresce menos que o Reno cresceria
+        self.w_est += 3 * (1 - self.BETA) / (1 + self.BETA) * \
+            bytes_reconhecidos * mss / self.cwnd
+        alvo = max(alvo, self.w_est)
+        if alvo > self.cwnd:
+            self.cwnd += min(alvo - self.cwnd, self.cwnd / 2) * \
+                bytes_reconhecidos / self.cwnd
+
+    def _reduzir(self):
+        if self.cwnd < self.w_max:
+            # Convergência rápida: libera banda para fluxos novos
+            self.w_max = self.cwnd * (1 + self.BETA) / 2
+        else:
+            self.w_max = self.cwnd
+        self.inicio_epoca = None
+
+    def on_loss(self, bytes_em_voo):
+        self._reduzir()
+        self.ssthresh = max(self.cwnd * self.BETA, 2.0 * self.mss)
+        self.cwnd = self.ssthresh + 3.0 * self.mss
+
+    def on_timeout(self, bytes_em_voo):
+        self._reduzir()
+        self.ssthresh = max(self.cwnd * self.BETA, 2.0 * self.mss)
+        self.cwnd = float(self.mss)
+
+
+class Atraso(ControleCongestionamento):
+    """
+    Controlador simples baseado em atraso, inspirado no BBR. Estima a banda
+    de gargalo (maior taxa de entrega vista recentemente) e o RTT mínimo, e
+    mantém cwnd em GANHO vezes o produto banda-atraso. Perdas isoladas não
+    reduzem a janela, o que evita subutilizar enlaces seriais com perdas
+    aleatórias; só o timeout volta a janela a 1 MSS.
+    """
+    __slots__ = ('rtt_min', 'instante_rtt_min', 'amostras_banda', 'inicio_rodada',
+                 'bytes_rodada', 'partida', 'banda_partida', 'rodadas_sem_crescer')
+
+    GANHO = 2.0
+    RODADAS_BANDA = 10
+    JANELA_RTT_MIN = 10.0
+
+    def __init__(self, mss=MSS):
+        super().__init__(mss)
+        self.rtt_min = None
+        self.instante_rtt_min = 0.0
+        self.amostras_banda = []
+        self.inicio_rodada = None
+        self.bytes_rodada = 0.0
+        self.partida = True
+        self.banda_partida = 0.0
+        self.rodadas_sem_crescer = 0
+
+    def banda(self):
+        return max(self.amostras_banda, default=0.0)
+
+    def on_ack(self, bytes_reconhecidos, rtt=None):
+        agora = time.monotonic()
+        if rtt is not None and (self.rtt_min is None or rtt <= self.rtt_min or
+                                agora - self.instante_rtt_min > self.JANELA_RTT_MIN):
+            self.rtt_min = rtt
+            self.instante_rtt_min = agora
+        if self.inicio_rodada is None:
+            self.inicio_rodada = agora
+        self.bytes_rodada += bytes_reconhecidos
+        if self.rtt_min is not None and agora - self.inicio_rodada >= self.rtt_min:
+            self._fim_rodada(agora)
+        if self.partida:
+            # Como no slow start, até a banda estimada parar de crescer
+            self._aumentar(bytes_reconhecidos)
+        elif self.rtt_min is not None:
+            bdp = self.banda() * self.rtt_min
+            self.cwnd = max(self.GANHO * bdp, 4.0 * self.mss)
+
+    def _fim_rodada(self, agora):
+        duracao = agora - self.inicio_rodada
+        if duracao > 0:
+            self.amostras_banda.append(self.bytes_rodada / duracao)
+            del self.amostras_banda[:-self.RODADAS_BANDA]
+        self.inicio_rodada = agora
+        self.bytes_rodada = 0.0
+        if self.partida:
+            banda = self.banda()
+            if banda > 1.25 * self.banda_partida:
+                self.banda_partida = banda
+                self.rodadas_sem_crescer = 0
+            else:
+                self.rodadas_sem_crescer += 1
+                if self.rodadas_sem_crescer >= 3:
+                    self.partida = False
+
+    def on_loss(self, bytes_em_voo):
+        # Mantém a janela; a banda estimada já reflete a perda
+        self.ssthresh = self.cwnd
+
+    def on_dup_ack(self):
+        pass
+
+    def on_partial_ack(self, bytes_reconhecidos):
+        pass
+
+    def on_recovery_exit(self, bytes_em_voo):
+        pass
+
+    def on_timeout(self, bytes_em_voo):
+        self.ssthresh = max(bytes_em_voo / 2.0, 2.0 * self.mss)
+        self.cwnd = float(self.mss)
+        self.partida = True
+        self.banda_partida = 0.0
+        self.rodadas_sem_crescer = 0
@@ -1,5 +1,78 @@
 from iputils import *
-import struct
+from collections import OrderedDict
+from checksum import calc_checksum, atualizar_checksum, soma_complemento_um, \
+    endereco_int
+from cabecalhos import IPV4, ICMP, PALAVRA, DUAS_PALAVRAS, TAMANHO_IPV4, \
+    CHECKSUM_IPV4, Pacote, ler_ipv4
+import traceback
+
+
+class TabelaEncaminhamento:
+    """
+    Tabela de encaminhamento com busca pelo maior prefixo (longest prefix
+    match). As rotas ficam em um dicionário por tamanho de prefixo, indexado
+    pela rede já mascarada, de forma que cada busca faz no máximo uma
+    consulta a dicionário por tamanho de prefixo presente na tabela, do maior
+    para o menor, independentemente do número de rotas.
+    """
+    def __init__(self, rotas=()):
+        self._por_prefixo = {}
+        self._ordem = []
+        for cidr, next_hop in rotas:
+            self.adicionar(cidr, next_hop)
+
+    @staticmethod
+    def _ler_cidr(cidr):
+        rede, prefixo = cidr.split('/')
+        prefixo = int(prefixo)
+        mascara = (0xFFFFFFFF << (32 - prefixo)) & 0xFFFFFFFF
+        rede_int = endereco_int(rede) & mascara
+        return rede_int, prefixo
+
+    def _reordenar(self):
+        self._ordem = [((0xFFFFFFFF << (32 - prefixo)) & 0xFFFFFFFF,
+                        self._por_prefixo[prefixo])
+                       for prefixo in sorted(self._por_prefixo, reverse=True)]
+
+    def adicionar(self, cidr, next_hop):
+        """
+        Adiciona (ou substitui) a rota para cidr ('x.y.z.w/n').
+        """
+        rede_int, prefixo = self._ler_cidr(cidr)
+        redes = self._por_prefixo.get(prefixo)
+        if redes is None:
+            redes = self._por_prefixo[prefixo] = {}
+            redes[rede_int] = next_hop
+            self._reordenar()
+        else:
+            redes[rede_int] = next_hop
+
+    def remover(self, cidr):
+        """
+        Remove a rota para cidr ('x.y.z.w/n'), se existir.
+        """
+        rede_int, prefixo = self._ler_cidr(cidr)
+        redes = self._por_prefixo.get(prefixo)
+        if redes is None or rede_int not in redes:
+            return
+        del redes[rede_int]
+        if not redes:
+            del self._por_prefixo[prefixo]
+            self._reordenar()
+
+    def buscar(self, dest_int):
+        """
+        Retorna o next_hop da rota de maior prefixo que contém dest_int
+        (endereço IPv4 como inteiro de 32 bits), ou None.
+        """
+        for mascara, redes in self._ordem:
+            next_hop = redes.get(dest_int & mascara)
+            if next_hop is not None:
+                return next_hop
+        return None
+
+    def __len__(self):
+        return sum(len(redes) for redes in self._por_prefixo.values())
 
 
 class IP:
@@ -12,16 +85,70 @@ class IP:
         self.callback = None
         self.enlace = enlace
         self.enlace.registrar_recebedor(self.__raw_recv)
+        if hasattr(self.enlace, 'registrar_recebedor_lote'):
+            self.enlace.registrar_recebedor_lote(self.__raw_recv_lote)
         self.ignore_checksum = self.enlace.ignore_checksum
+        # Enlaces que aceitam um Pacote escrevem o quadro na folga dele
+        self._enviar_pacote_enlace = getattr(self.enlace, 'enviar_pacote', None)
         self.meu_endereco = None
-        self.tabela_encaminhamento = []
+        self._meu_endereco_int = None
+        # Modelos de cabeçalho por (destino, protocolo), vide enviar.
+        self._modelos_cabecalho = {}
+        self.tabela_encaminhamento = TabelaEncaminhamento()
+        # Cache LRU de next_hop por endereço de destino. É trocado por um
+        # novo objeto sempre que a tabela muda, então nunca fica inconsistente.
+        self.tamanho_cache_next_hop = 256
+        self._cache_next_hop = OrderedDict()
+        self.cache_acertos = 0
+        self.cache_falhas = 0
+
+    def __raw_recv_lote(self, datagramas):
+        """
+        Processa de uma vez todos os datagramas recebidos em uma mesma
+        leitura do enlace. O que não muda dentro do lote (nosso endereço, o
+        callback e o cache de next_hop) é lido uma vez só, e os casos comuns
+        (datagrama para nós e encaminhamento com o next_hop no cache) são
+        tratados aqui mesmo, sem passar por __raw_recv. Um datagrama com erro
+        não impede os demais.
+        """
+        meu_endereco = self._meu_endereco_int
+        callback = self.callback
+        cache = self._cache_next_hop
+        unpack_from = IPV4.unpack_from
+        acertos = 0
+        restantes = iter(datagramas)
+        while True:
+            # O try envolve o laço inteiro, e não cada datagrama: depois de
+            # um erro, o laço continua do datagrama seguinte
+            try:
+                for datagrama in restantes:
+                    vihl, _, total_len, _, _, ttl, proto, _, src_addr, dst_addr = \
+                        unpack_from(datagrama)
+                    if dst_addr == meu_endereco:
+                        if proto == IPPROTO_TCP and callback:
+                            callback(src_addr, dst_addr, datagrama[4*(vihl & 0xf):total_len])
+                    elif ttl > 1 and dst_addr in cache:
+                        cache.move_to_end(dst_addr)
+                        acertos += 1
+                        self._encaminhar(datagrama, ttl, proto, cache[dst_addr])
+                    else:
+                        # TTL expirado ou destino fora do cache
+                        self.__raw_recv(datagrama)
+                break
+            except Exception:
+                traceback.print_exc()
+        self.cache_acertos += acertos
 
     def __raw_recv(self, datagrama):
-        dscp, ecn, identification, flags, frag_offset, ttl, proto, \
-           src_addr, dst_addr, payload = read_ipv4_header(datagrama)
-        if dst_addr == self.meu_endereco:
+        # Os endereços são tratados como inteiros de 32 bits dentro da pilha;
+        # só viram string na fronteira com quem configura a rede.
+        vihl, dscpecn, total_len, identification, flagsfrag, ttl, proto, \
+            checksum, src_addr, dst_addr = \
+            ler_ipv4(datagrama)
+        if dst_addr == self._meu_endereco_int:
             # atua como host
             if proto == IPPROTO_TCP and self.callback:
+                payload = datagrama[4*(vihl & 0xf):total_len]
                 self.callback(src_addr, dst_addr, payload)
         else:
             # atua como roteador
@@ -33,67 +160,80 @@ class IP:
                 icmp_code = 0
                 icmp_unused = 0
                 # O payload do ICMP deve conter o cabeçalho IP original + 8 bytes do payload original
-                original_header = datagrama[:20]
-                original_payload = datagrama[20:28] if len(datagrama) > 28 else datagrama[20:]
-                icmp_payload = original_header + original_payload
-                icmp_header = struct.pack('!BBHI', icmp_type, icmp_code, 0, icmp_unused)
+                icmp_payload = bytes(datagrama[:28])
+                icmp_header = ICMP.pack(icmp_type, icmp_code, 0, icmp_unused)
                 icmp_datagram = icmp_header + icmp_payload
                 # Calcula checksum ICMP
                 icmp_checksum = calc_checksum(icmp_datagram)
-                icmp_header = struct.pack('!BBHI', icmp_type, icmp_code, icmp_checksum, icmp_unused)
+                icmp_header = ICMP.pack(icmp_type, icmp_code, icmp_checksum, icmp_unused)
                 icmp_datagram = icmp_header + icmp_payload
                 # Monta datagrama IP para ICMP
                 version = 4
                 ihl = 5
                 vihl = (version << 4) + ihl
-                dscpecn = (dscp << 2) + ecn
                 total_len = 20 + len(icmp_datagram)
-                flagsfrag = (flags << 13) + frag_offset
                 novo_ttl = 64
                 proto_num = IPPROTO_ICMP
                 checksum = 0
-                src_addr_bytes = str2addr(self.meu_endereco)
-                dst_addr_bytes = str2addr(src_addr)
-                cabecalho = struct.pack('!BBHHHBBH4s4s',
-                    vihl, dscpecn, total_len, identification, flagsfrag, novo_ttl, proto_num, checksum, src_addr_bytes, dst_addr_bytes)
+                cabecalho = IPV4.pack(
+                    vihl, dscpecn, total_len, identification, flagsfrag, novo_ttl, proto_num, checksum, self._meu_endereco_int, src_addr)
                 checksum = calc_checksum(cabecalho)
-                cabecalho = struct.pack('!BBHHHBBH4s4s',
-                    vihl, dscpecn, total_len, identification, flagsfrag, novo_ttl, proto_num, checksum, src_addr_bytes, dst_addr_bytes)
+                cabecalho = IPV4.pack(
+                    vihl, dscpecn, total_len, identification, flagsfrag, novo_ttl, proto_num, checksum, self._meu_endereco_int, src_addr)
                 datagrama_icmp = cabecalho + icmp_datagram
                 next_hop_icmp = self._next_hop(src_addr)
                 self.enlace.enviar(datagrama_icmp, next_hop_icmp)
                 return
-            novo_ttl = ttl - 1
-            # Reconstrói o cabeçalho IP com novo TTL e checksum
-            version = 4
-            ihl = 5
-            vihl = (version << 4) + ihl
-            dscpecn = (dscp << 2) + ecn
-            total_len = 20 + len(payload)
-            flagsfrag = (flags << 13) + frag_offset
-            proto_num = proto
-            checksum = 0
-            src_addr_bytes = str2addr(src_addr)
-            dst_addr_bytes = str2addr(dst_addr)
-            cabecalho = struct.pack('!BBHHHBBH4s4s',
-                vihl, dscpecn, total_len, identification, flagsfrag, novo_ttl, proto_num, checksum, src_addr_bytes, dst_addr_bytes)
-            checksum = calc_checksum(cabecalho)
-            cabecalho = struct.pack('!BBHHHBBH4s4s',
-                vihl, dscpecn, total_len, identification, flagsfrag, novo_ttl, proto_num, checksum, src_addr_bytes, dst_addr_bytes)
-            novo_datagrama = cabecalho + payload
-            self.enlace.enviar(novo_datagrama, next_hop)
+            self._encaminhar(datagrama, ttl, proto, next_hop)
+
+    def _encaminhar(self, datagrama, ttl, proto, next_hop):
+        """
+        Encaminha o datagrama decrementando o TTL. Em vez de remontar o
+        cabeçalho, altera só o byte do TTL e corrige o checksum de forma
+        incremental (RFC 1624).
+
+        O enlace entrega bytes ou memoryviews só de leitura, então o
+        datagrama inteiro é sempre copiado uma vez, para um Pacote. A
+        alteração é feita nessa cópia, e o SLIP põe os ENDs na folga dela
+        sem copiar de novo.
+        """
+        pacote = Pacote.de(datagrama, 1)
+        buffer, inicio = pacote.buffer, pacote.inicio
+        checksum, = PALAVRA.unpack_from(buffer, inicio + CHECKSUM_IPV4)
+        checksum = atualizar_checksum(checksum, (ttl << 8) | proto,
+                                      ((ttl - 1) << 8) | proto)
+        buffer[inicio + 8] = ttl - 1
+        PALAVRA.pack_into(buffer, inicio + CHECKSUM_IPV4, checksum)
+        self._enviar_enlace(pacote, next_hop)
+
+    def _enviar_enlace(self, datagrama, next_hop):
+        """
+        Passa ao enlace um datagrama guardado em um Pacote.
+        """
+        if self._enviar_pacote_enlace is not None:
+            self._enviar_pacote_enlace(datagrama, next_hop)
+        else:
+            self.enlace.enviar(bytes(datagrama), next_hop)
 
     def _next_hop(self, dest_addr):
-        dest_int = int.from_bytes(str2addr(dest_addr), 'big')
-        melhor_prefixo = -1
-        melhor_next_hop = None
-        for rede_int, mascara, next_hop in self.tabela_encaminhamento:
-            if (dest_int & mascara) == (rede_int & mascara):
-                prefixo = bin(mascara).count('1')
-                if prefixo > melhor_prefixo:
-                    melhor_prefixo = prefixo
-                    melhor_next_hop = next_hop
-        return melhor_next_hop
+        cache = self._cache_next_hop
+        try:
+            next_hop = cache[dest_addr]
+        except KeyError:
+            pass
+        else:
+            cache.move_to_end(dest_addr)
+            self.cache_acertos += 1
+            return next_hop
+        self.cache_falhas += 1
+        next_hop = self.tabela_encaminhamento.buscar(dest_addr)
+        cache[dest_addr] = next_hop
+        if len(cache) > self.tamanho_cache_next_hop:
+            cache.popitem(last=False)
+        return next_hop
+
+    def _invalidar_cache_next_hop(self):
+        self._cache_next_hop = OrderedDict()
 
     def definir_endereco_host(self, meu_endereco):
         """
@@ -102,6 +242,8 @@ class IP:
         atuaremos como roteador em vez de atuar como host.
         """
         self.meu_endereco = meu_endereco
+        self._meu_endereco_int = endereco_int(meu_endereco)
+        self._modelos_cabecalho = {}
 
     def definir_tabela_encaminhamento(self, tabela):
         """
@@ -111,13 +253,23 @@ class IP:
         Onde os CIDR são fornecidos no formato 'x.y.z.w/n', e os
         next_hop são fornecidos no formato 'x.y.z.w'.
         """
-        self.tabela_encaminhamento = []
-        for cidr, next_hop in tabela:
-            rede, prefixo = cidr.split('/')
-            rede_int = int.from_bytes(str2addr(rede), 'big')
-            prefixo = int(prefixo)
-            mascara = (0xFFFFFFFF << (32 - prefixo)) & 0xFFFFFFFF
-            self.tabela_encaminhamento.append((rede_int, mascara, next_hop))
+        self.tabela_encaminhamento = TabelaEncaminhamento(tabela)
+        self._invalidar_cache_next_hop()
+
+    def adicionar_rota(self, cidr, next_hop):
+        """
+        Adiciona (ou substitui) uma rota na tabela de encaminhamento, sem
+        precisar redefinir a tabela inteira.
+        """
+        self.tabela_encaminhamento.adicionar(cidr, next_hop)
+        self._invalidar_cache_next_hop()
+
+    def remover_rota(self, cidr):
+        """
+        Remove a rota para cidr ('x.y.z.w/n') da tabela de encaminhamento.
+        """
+        self.tabela_encaminhamento.remover(cidr)
+        self._invalidar_cache_next_hop()
 
     def registrar_recebedor(self, callback):
         """
@@ -125,36 +277,53 @@ class IP:
         """
         self.callback = callback
 
+    def _modelo_cabecalho(self, dest_addr, proto):
+        """
+        Retorna o modelo de cabeçalho IPv4 para (meu_endereco, dest_addr,
+        proto), com total_len, identification e checksum zerados, e a soma
+        complemento-de-um parcial desses campos fixos.
+        """
+        chave = (dest_addr, proto)
+        modelo = self._modelos_cabecalho.get(chave)
+        if modelo is None:
+            if len(self._modelos_cabecalho) >= self.tamanho_cache_next_hop:
+                self._modelos_cabecalho = {}
+            version = 4
+            ihl = 5  # sem opções
+            vihl = (version << 4) + ihl
+            ttl = 64
+            cabecalho = IPV4.pack(vihl, 0, 0, 0, 0, ttl,
+                                  proto, 0, self._meu_endereco_int, dest_addr)
+            modelo = self._modelos_cabecalho[chave] = \
+                (cabecalho, soma_complemento_um(cabecalho))
+        return modelo
+
     def enviar(self, segmento, dest_addr):
         """
         Envia segmento para dest_addr, onde dest_addr é um endereço IPv4
-        (string no formato x.y.z.w).
+        (string no formato x.y.z.w ou inteiro de 32 bits).
+        """
+        self.enviar_pacote(Pacote.de(segmento), dest_addr)
+
+    def enviar_pacote(self, segmento, dest_addr):
+        """
+        Como enviar, mas recebe o segmento em um Pacote (vide cabecalhos.py)
+        e escreve o cabeçalho IP na folga da frente dele, sem copiar o
+        segmento.
         """
+        dest_addr = endereco_int(dest_addr)
         next_hop = self._next_hop(dest_addr)
-        # Cabeçalho IPv4
-        version = 4
-        ihl = 5  # sem opções
-        vihl = (version << 4) + ihl
-        dscp = 0
-        ecn = 0
-        dscpecn = (dscp << 2) + ecn
+        # Só total_len e identification mudam entre datagramas do mesmo
+        # destino, então basta somá-los à soma parcial do modelo.
+        modelo, soma = self._modelo_cabecalho(dest_addr, IPPROTO_TCP)
         total_len = 20 + len(segmento)
         identification = 0
-        flags = 0
-        frag_offset = 0
-        flagsfrag = (flags << 13) + frag_offset
-        ttl = 64
-        proto = IPPROTO_TCP
-        checksum = 0
-        src_addr = str2addr(self.meu_endereco)
-        dst_addr = str2addr(dest_addr)
-        # Monta cabeçalho sem checksum
-        cabecalho = struct.pack('!BBHHHBBH4s4s',
-            vihl, dscpecn, total_len, identification, flagsfrag, ttl, proto, checksum, src_addr, dst_addr)
-        # Calcula checksum
-        checksum = calc_checksum(cabecalho)
-        # Monta cabeçalho final com checksum
-        cabecalho = struct.pack('!BBHHHBBH4s4s',
-            vihl, dscpecn, total_len, identification, flagsfrag, ttl, proto, checksum, src_addr, dst_addr)
-        datagrama = cabecalho + segmento
-        self.enlace.enviar(datagrama, next_hop)
+        soma += total_len + identification
+        soma = (soma & 0xffff) + (soma >> 16)
+        soma = (soma & 0xffff) + (soma >> 16)
+        datagrama = segmento.prefixar(TAMANHO_IPV4)
+        buffer, inicio = datagrama.buffer, datagrama.inicio
+        buffer[inicio:inicio + TAMANHO_IPV4] = modelo
+        DUAS_PALAVRAS.pack_into(buffer, inicio + 2, total_len, identification)
+        PALAVRA.pack_into(buffer, inicio + CHECKSUM_IPV4, ~soma & 0xffff)
+        self._enviar_enlace(datagrama, next_hop)
@@ -6,6 +6,77 @@ import re
 nick_map = {}
 channels = {}
 
+# Tamanho máximo de uma mensagem IRC, contando o \r\n (RFC 1459, 2.3)
+TAMANHO_MAXIMO_LINHA = 512
+
+class DivisorLinhas:
+    """
+    Separa em linhas o fluxo de bytes de um cliente. Cada pedaço recebido é
+    percorrido uma única vez: o que sobra sem terminador fica guardado junto
+    com até onde já foi varrido, para a busca continuar dali no próximo
+    pedaço. Aceita tanto \r\n quanto \n sozinho. Linhas maiores que o
+    limite do IRC são truncadas e o restante delas é descartado.
+    """
+    __slots__ = ('buffer', 'varrido', 'descartando')
+
+    def __init__(self):
+        self.buffer = None
+        self.varrido = 0
+        self.descartando = False
+
+    def alimentar(self, dados):
+        """Retorna a lista das linhas completadas por dados, sem terminador."""
+        linhas = []
+        if self.buffer:
+            self.buffer += dados
+            buffer = self.buffer
+        elif isinstance(dados, (bytes, bytearray)):
+            buffer = dados
+        else:
+            buffer = bytes(dados)
+        tamanho = len(buffer)
+        maximo = TAMANHO_MAXIMO_LINHA - 2
+        inicio = 0
+        pos = self.varrido
+        while inicio < tamanho:
+            fim = buffer.find(b'\n', pos)
+            if fim == -1:
+                if not self.descartando and tamanho - inicio > maximo + 1:
+                    # Linha longa demais e ainda sem fim: fica só o começo
+                    linhas.append(bytes(buffer[inicio:inicio + maximo]))
+                    self.descartando = True
+                if self.descartando:
+                    inicio = tamanho
+                break
+            if self.descartando:
+                self.descartando = False
+            else:
+                linha = buffer[inicio:fim]
+                if linha.endswith(b'\r'):
+                    linha = linha[:-1]
+                linhas.append(bytes(linha[:maximo]))
+            inicio = pos = fim + 1
+        # Guarda o que sobrou, que já foi todo varrido sem achar o \n
+        if inicio == tamanho:
+            self.buffer = None
+            self.varrido = 0
+        else:
+            if buffer is self.buffer:
+                del buffer[:inicio]
+            else:
+                self.buffer = bytearray(buffer[inicio:])
+            self.varrido = tamanho - inicio
+        return linhas
+
+class Usuario:
+    """Estado de um cliente IRC, guardado em conexao.dados_app."""
+    __slots__ = ('nick', 'lower_nick', 'linhas')
+
+    def __init__(self):
+        self.nick = None
+        self.lower_nick = None
+        self.linhas = DivisorLinhas()
+
 def validar_nome(nome):
     return re.match(br'^[a-zA-Z][a-zA-Z0-9_-]*$', nome) is not None
 
@@ -13,7 +84,7 @@ def enviar(conexao, msg):
     conexao.enviar((msg + "\r\n").encode("utf-8"))
 
 def sair(conexao):
-    nick = getattr(conexao, 'nick', None)
+    nick = conexao.dados_app.nick
     if nick:
         # Notificar canais que o usuário saiu
         for cset in channels.values():
@@ -23,7 +94,7 @@ def sair(conexao):
                         enviar(outro, f":{nick} QUIT :Connection closed")
                 cset.remove(conexao)
         # Remover dos mapas
-        lower_nick = getattr(conexao, 'lower_nick', None)
+        lower_nick = conexao.dados_app.lower_nick
         if lower_nick in nick_map:
             del nick_map[lower_nick]
     print(conexao, 'conexão fechada')
@@ -37,8 +108,9 @@ def compartilham_canal(connA, connB):
     return False
 
 def process_line(conexao, line):
-    nick = getattr(conexao, 'nick', None)
-    lower_nick = getattr(conexao, 'lower_nick', None)
+    usuario = conexao.dados_app
+    nick = usuario.nick
+    lower_nick = usuario.lower_nick
     parts = line.split(b' ', 1)
     if not parts:
         return
@@ -81,8 +153,8 @@ def process_line(conexao, line):
             enviar(conexao, f":server 001 {new_nick.decode()} :Welcome")
             enviar(conexao, f":server 422 {new_nick.decode()} :MOTD File is missing")
 
-        conexao.nick = new_nick.decode()
-        conexao.lower_nick = lower_new
+        usuario.nick = new_nick.decode()
+        usuario.lower_nick = lower_new
         nick_map[lower_new] = conexao
 
     elif cmd == b'PRIVMSG':  # Passo 5 e 6
@@ -121,7 +193,7 @@ def process_line(conexao, line):
         cset.add(conexao)
         enviar(conexao, f":{nick} JOIN :{canal}")
         # 353 e 366
-        membros = sorted([getattr(u, 'nick', '') for u in cset], key=str.lower)
+        membros = sorted([u.dados_app.nick or '' for u in cset], key=str.lower)
         membros_str = " ".join(membros)
         base_msg = f":server 353 {nick} = {canal} :"
         while len(base_msg + membros_str) >= 510:
@@ -148,27 +220,33 @@ def process_line(conexao, line):
             cset.remove(conexao)
 
 def dados_recebidos(conexao, dados):
-    if not hasattr(conexao, 'buffer'):
-        conexao.buffer = b''
+    usuario = conexao.dados_app
     if dados == b'':
         return sair(conexao)
-    conexao.buffer += dados
-    while b'\r\n' in conexao.buffer:
-        line, conexao.buffer = conexao.buffer.split(b'\r\n', 1)
-        line = line.strip(b'\n\r')
-        if line:
-            process_line(conexao, line)
+    linhas = usuario.linhas.alimentar(dados)
+    if not linhas:
+        return
+    # Junta todas as respostas a este pedaço de dados em poucos segmentos
+    conexao.tampar()
+    try:
+        for line in linhas:
+            if line:
+                process_line(conexao, line)
+    finally:
+        conexao.destampar()
+
+def recebedor(c, d):
+    try:
+        dados_recebidos(c, d)
+    except ConnectionResetError:
+        sair(c)
 
 def conexao_aceita(conexao):
     print(conexao, 'nova conexão')
-
-    def wrapper(c, d):
-        try:
-            dados_recebidos(c, d)
-        except ConnectionResetError:
-            sair(c)
-
-    conexao.registrar_recebedor(wrapper)
+    conexao.dados_app = Usuario()
+    # Uma única função para todas as conexões, em vez de uma closure por
+    # conexão
+    conexao.registrar_recebedor(recebedor)
 
 if __name__ == "__main__":
     servidor = Servidor(6667)
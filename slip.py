@@ -1,3 +1,6 @@
+import traceback
+
+
 class CamadaEnlace:
     ignore_checksum = False
 
@@ -10,14 +13,21 @@ class CamadaEnlace:
         uma string no formato 'x.y.z.w'. A linha_serial é um objeto da classe
         PTY (vide camadafisica.py) ou de outra classe que implemente os métodos
         registrar_recebedor e enviar.
+
+        Se a classe da linha serial tiver o atributo envio_sincrono
+        verdadeiro, o seu enviar precisa consumir os dados antes de retornar
+        (sem guardá-los para enviar depois), pois pode receber uma
+        memoryview de um buffer que será alterado em seguida.
         """
         self.enlaces = {}
         self.callback = None
+        self.callback_lote = None
         # Constrói um Enlace para cada linha serial
         for ip_outra_ponta, linha_serial in linhas_seriais.items():
             enlace = Enlace(linha_serial)
             self.enlaces[ip_outra_ponta] = enlace
             enlace.registrar_recebedor(self._callback)
+            enlace.registrar_recebedor_lote(self._callback_lote)
 
     def registrar_recebedor(self, callback):
         """
@@ -25,6 +35,14 @@ class CamadaEnlace:
         """
         self.callback = callback
 
+    def registrar_recebedor_lote(self, callback):
+        """
+        Registra uma função para ser chamada com a lista de todos os
+        datagramas recebidos em uma mesma leitura da linha serial. Se
+        registrada, é usada no lugar da função de registrar_recebedor.
+        """
+        self.callback_lote = callback
+
     def enviar(self, datagrama, next_hop):
         """
         Envia datagrama para next_hop, onde next_hop é um endereço IPv4
@@ -34,83 +52,111 @@ class CamadaEnlace:
         # Encontra o Enlace capaz de alcançar next_hop e envia por ele
         self.enlaces[next_hop].enviar(datagrama)
 
+    def enviar_pacote(self, datagrama, next_hop):
+        """
+        Como enviar, mas recebe o datagrama em um Pacote (vide cabecalhos.py).
+        """
+        self.enlaces[next_hop].enviar_pacote(datagrama)
+
     def _callback(self, datagrama):
         if self.callback:
             self.callback(datagrama)
 
+    def _callback_lote(self, datagramas):
+        if self.callback_lote:
+            self.callback_lote(datagramas)
+        elif self.callback:
+            for datagrama in datagramas:
+                try:
+                    self.callback(datagrama)
+                except Exception:
+                    traceback.print_exc()
+
 
 class Enlace:
     def __init__(self, linha_serial):
         self.linha_serial = linha_serial
         self.linha_serial.registrar_recebedor(self.__raw_recv)
-        self._recv_buffer = bytearray()
-        self._frame_buffer = bytearray()
+        # Só linhas que consomem os dados dentro de enviar() (sem guardá-los
+        # em uma fila) recebem uma visão do buffer do Pacote, vide
+        # enviar_pacote
+        self._envio_sincrono = getattr(linha_serial, 'envio_sincrono', False)
+        self._frame_buffer = b''
         self.callback = None
+        self.callback_lote = None
 
     def registrar_recebedor(self, callback):
         self.callback = callback
 
+    def registrar_recebedor_lote(self, callback):
+        self.callback_lote = callback
+
     def enviar(self, datagrama):
-        SLIP_END = 0xC0
-        SLIP_ESC = 0xDB
-        SLIP_ESC_END = 0xDC
-        SLIP_ESC_ESC = 0xDD
-        # Aplica escape nos bytes do datagrama
-        quadro = bytearray()
-        quadro.append(SLIP_END)
-        for byte in datagrama:
-            if byte == SLIP_END:
-                quadro.append(SLIP_ESC)
-                quadro.append(SLIP_ESC_END)
-            elif byte == SLIP_ESC:
-                quadro.append(SLIP_ESC)
-                quadro.append(SLIP_ESC_ESC)
-            else:
-                quadro.append(byte)
-        quadro.append(SLIP_END)
-        self.linha_serial.enviar(bytes(quadro))
+        # Aplica escape nos bytes do datagrama. O ESC precisa ser escapado
+        # antes do END, senão o ESC inserido no lugar do END seria escapado
+        # de novo.
+        quadro = bytes(datagrama).replace(b'\xdb', b'\xdb\xdd') \
+                                 .replace(b'\xc0', b'\xdb\xdc')
+        self.linha_serial.enviar(b'\xc0' + quadro + b'\xc0')
+
+    def enviar_pacote(self, datagrama):
+        # Sem bytes a escapar (o caso comum), os ENDs vão nas folgas do
+        # próprio Pacote e o quadro sai direto do buffer. O TCP guarda esse
+        # buffer para retransmissões e o altera depois (TSval, checksum), então
+        # a visão sem cópia só vai para linhas com envio_sincrono; as demais
+        # recebem bytes, como em enviar.
+        buffer, inicio, fim = datagrama.buffer, datagrama.inicio, datagrama.fim
+        if buffer.find(b'\xdb', inicio, fim) != -1 or buffer.find(b'\xc0', inicio, fim) != -1:
+            self.enviar(datagrama.dados())
+            return
+        if inicio < 1 or fim >= len(buffer):
+            datagrama = datagrama.prefixar(1).sufixar(1)
+            buffer, inicio, fim = datagrama.buffer, datagrama.inicio + 1, datagrama.fim - 1
+        buffer[inicio - 1] = 0xc0
+        buffer[fim] = 0xc0
+        quadro = memoryview(buffer)[inicio - 1:fim + 1]
+        if self._envio_sincrono:
+            self.linha_serial.enviar(quadro)
+        else:
+            self.linha_serial.enviar(bytes(quadro))
 
     def __raw_recv(self, dados):
-        SLIP_END = 0xC0
-        SLIP_ESC = 0xDB
-        SLIP_ESC_END = 0xDC
-        SLIP_ESC_ESC = 0xDD
-        for byte in dados:
-            if byte == SLIP_END:
-                if len(self._frame_buffer) > 0:
-                    # Desescape
-                    datagrama = bytearray()
-                    i = 0
-                    while i < len(self._frame_buffer):
-                        if self._frame_buffer[i] == SLIP_ESC:
-                            if i+1 < len(self._frame_buffer):
-                                if self._frame_buffer[i+1] == SLIP_ESC_END:
-                                    datagrama.append(SLIP_END)
-                                    i += 2
-                                elif self._frame_buffer[i+1] == SLIP_ESC_ESC:
-                                    datagrama.append(SLIP_ESC)
-                                    i += 2
-                                else:
-                                    datagrama.append(SLIP_ESC)
-                                    i += 1
-                            else:
-                                datagrama.append(SLIP_ESC)
-                                i += 1
-                        else:
-                            datagrama.append(self._frame_buffer[i])
-                            i += 1
-                    if len(datagrama) > 0 and self.callback:
-                        try:
-                            self.callback(bytes(datagrama))
-                        except Exception:
-                            import traceback
-                            traceback.print_exc()
-                        finally:
-                            # Limpa o buffer do quadro, mesmo em caso de erro
-                            self._frame_buffer = bytearray()
-                    else:
-                        self._frame_buffer = bytearray()
+        # Junta o pedaço de quadro que sobrou da última leitura e recorta de
+        # uma vez todos os quadros completos (terminados em END). O que vier
+        # depois do último END fica guardado para a próxima leitura.
+        if self._frame_buffer:
+            buf = self._frame_buffer + dados
+        else:
+            buf = bytes(dados)
+        visao = memoryview(buf)
+        datagramas = []
+        inicio = 0
+        while True:
+            fim = buf.find(b'\xc0', inicio)
+            if fim == -1:
+                break
+            if fim > inicio:
+                if buf.find(b'\xdb', inicio, fim) == -1:
+                    # Sem escapes: entrega uma fatia, sem copiar o quadro
+                    datagramas.append(visao[inicio:fim])
                 else:
-                    self._frame_buffer = bytearray()
-            else:
-                self._frame_buffer.append(byte)
+                    # Desescape
+                    datagramas.append(
+                        buf[inicio:fim].replace(b'\xdb\xdc', b'\xc0')
+                                       .replace(b'\xdb\xdd', b'\xdb'))
+            inicio = fim + 1
+        self._frame_buffer = buf[inicio:]
+        if not datagramas:
+            return
+        if self.callback_lote:
+            # Entrega todos os datagramas desta leitura em uma só chamada
+            try:
+                self.callback_lote(datagramas)
+            except Exception:
+                traceback.print_exc()
+        elif self.callback:
+            for datagrama in datagramas:
+                try:
+                    self.callback(datagrama)
+                except Exception:
+                    traceback.print_exc()
@@ -1,67 +1,540 @@
-import asyncio
 from tcputils import *
+from checksum import calc_checksum, preencher_checksum
+from cabecalhos import PALAVRA, PALAVRA_DUPLA, PAR, OPCAO_TS, CHECKSUM_TCP, \
+    ler_tcp, novo_segmento
+from congestionamento import NewReno
+from temporizador import RodaTemporizacao
+from collections import deque, OrderedDict
+import heapq
 import random
 import time
 
+# Tipos de opção do cabeçalho TCP
+TCPOPT_EOL = 0
+TCPOPT_NOP = 1
+TCPOPT_WSCALE = 3
+TCPOPT_SACK_PERMITTED = 4
+TCPOPT_SACK = 5
+TCPOPT_TIMESTAMP = 8
+
+# Quantidade máxima de blocos SACK que cabem nas opções de um ACK (só 3
+# se o ACK também levar a opção de timestamps)
+MAX_BLOCOS_SACK = 4
+MAX_BLOCOS_SACK_COM_TS = 3
+
+# Espaço ocupado pela opção de timestamps alinhada (NOP, NOP, TS)
+TAMANHO_OPCAO_TS = 12
+
+# Tempo máximo (em segundos) que um ACK pode ser atrasado à espera de um
+# segundo segmento ou de dados da aplicação para ir de carona
+ATRASO_ACK = 0.05
+
+# Tamanho padrão do buffer de recepção de cada conexão, que limita a janela
+# anunciada ao cliente
+TAMANHO_BUFFER_RECEPCAO = 8*MSS
+
+# Intervalo máximo (em segundos) entre sondas de janela zero
+PERSISTENCIA_MAXIMA = 60.0
+
+# Retransmissões (ou sondas de janela) seguidas sem resposta antes de
+# desistir da conexão, e o RTO máximo alcançado pelo backoff exponencial
+MAX_RETRANSMISSOES = 8
+RTO_MAXIMO = 60.0
+
+# Limites das tabelas do Servidor (por padrão, o número de conexões
+# abertas não é limitado)
+MAX_CONEXOES = None
+MAX_SEMIABERTAS = 256
+MAX_TIME_WAIT = 256
+
+# Tempos (em segundos) depois dos quais as entradas das tabelas do Servidor
+# são descartadas, e o intervalo entre as varreduras que descartam as
+# semiabertas e as em TIME_WAIT
+TEMPO_SEMIABERTA = 30.0
+TEMPO_FIN_WAIT_2 = 60.0
+TEMPO_TIME_WAIT = 60.0
+INTERVALO_COLETA = 5.0
+
+# Tempo (em segundos) sem receber nada depois do qual uma conexão
+# estabelecida é abortada, para que clientes que somem sem mandar FIN não
+# fiquem na tabela para sempre (clientes IRC mandam PING bem antes disso)
+TEMPO_OCIOSO = 900.0
+
+
+def montar_cabecalho(src_port, dst_port, seq_no, ack_no, flags, opcoes=b'',
+                     janela=8*MSS):
+    """
+    Constrói um cabeçalho TCP como o de tcputils.make_header, mas podendo
+    levar opções (já alinhadas em múltiplos de 4 bytes, vide montar_opcoes)
+    e anunciar outra janela (já deslocada pela escala, se houver).
+
+    Devolve um Pacote (vide cabecalhos.py) com o checksum zerado, que é
+    preenchido por fechar_segmento.
+    """
+    return novo_segmento(src_port, dst_port, seq_no, ack_no, flags, janela, opcoes)
+
+
+def fechar_segmento(segmento, src_addr, dst_addr):
+    """
+    Preenche, no próprio Pacote, o checksum de um segmento montado com o
+    campo zerado.
+    """
+    preencher_checksum(segmento.dados(), src_addr, dst_addr)
+    return segmento
+
+
+def montar_opcoes(*opcoes):
+    """
+    Junta as opções fornecidas, completando com NOPs no começo para que o
+    tamanho total seja múltiplo de 4 bytes.
+    """
+    dados = b''.join(opcoes)
+    return bytes([TCPOPT_NOP]) * (-len(dados) % 4) + dados
+
+
+def opcao_sack(blocos):
+    """
+    Monta a opção SACK (RFC 2018) com os blocos [(inicio, fim), ...].
+    """
+    return bytes([TCPOPT_SACK, 2 + 8*len(blocos)]) + \
+        b''.join(PAR.pack(inicio, fim) for inicio, fim in blocos)
+
+
+def ler_opcoes(opcoes):
+    """
+    Lê as opções de um cabeçalho TCP, devolvendo um dicionário
+    {tipo: conteúdo}.
+    """
+    resultado = {}
+    i = 0
+    while i < len(opcoes):
+        tipo = opcoes[i]
+        if tipo == TCPOPT_EOL:
+            break
+        if tipo == TCPOPT_NOP:
+            i += 1
+            continue
+        if i + 1 >= len(opcoes) or opcoes[i+1] < 2:
+            break
+        tamanho = opcoes[i+1]
+        resultado[tipo] = bytes(opcoes[i+2:i+tamanho])
+        i += tamanho
+    return resultado
+
+
+def opcao_ts(tsval, tsecr):
+    """
+    Monta a opção de timestamps (RFC 7323), já alinhada com dois NOPs.
+    """
+    return OPCAO_TS.pack(TCPOPT_NOP, TCPOPT_NOP, TCPOPT_TIMESTAMP, 10, tsval, tsecr)
+
+
+def relogio_ts():
+    """
+    Relógio dos timestamps TCP (RFC 7323): milissegundos de um relógio
+    monotônico, módulo 2**32.
+    """
+    return (time.monotonic_ns() // 1000000) & 0xffffffff
+
+
+def ler_blocos_sack(conteudo):
+    """
+    Converte o conteúdo de uma opção SACK em uma lista [(inicio, fim), ...].
+    """
+    return list(PAR.iter_unpack(conteudo[:len(conteudo) - len(conteudo) % 8]))
+
+
 class Servidor:
-    def __init__(self, rede, porta):
+    def __init__(self, rede, porta, controle_congestionamento=NewReno,
+                 buffer_recepcao=TAMANHO_BUFFER_RECEPCAO,
+                 max_conexoes=MAX_CONEXOES, tempo_ocioso=TEMPO_OCIOSO):
+        """
+        controle_congestionamento é a classe (vide congestionamento.py) usada
+        para criar o controlador de congestionamento de cada conexão.
+
+        buffer_recepcao é o máximo de bytes que cada conexão guarda antes de
+        entregar à aplicação. Buffers maiores que 64 KiB só são anunciados
+        por inteiro se o cliente negociar a escala de janela (RFC 7323).
+
+        Se max_conexoes for dado, limita o número de conexões abertas ou em
+        abertura ao mesmo tempo; os SYNs que chegarem com a tabela cheia são
+        ignorados (sem RST), então o cliente só desiste depois de
+        retransmitir o SYN algumas vezes.
+
+        Conexões que não recebem nada por tempo_ocioso segundos são
+        abortadas (None as deixa abertas indefinidamente).
+        """
         self.rede = rede
         self.porta = porta
+        self.controle_congestionamento = controle_congestionamento
+        self.buffer_recepcao = buffer_recepcao
+        self.max_conexoes = max_conexoes
+        self.tempo_ocioso = tempo_ocioso
+        # Temporizadores de todas as conexões (retransmissão, ACK atrasado
+        # e persistência) ficam em uma única roda
+        self.roda = RodaTemporizacao()
+        self._timer_coleta = self.roda.criar(self._coletar)
+        # Menor deslocamento que faz o buffer caber nos 16 bits da janela
+        self.escala_recepcao = min(max(buffer_recepcao.bit_length() - 16, 0), 14)
         self.conexoes = {}
+        # Conexões que ainda esperam o ACK final do handshake e conexões
+        # fechadas por nós em TIME_WAIT, ambas em ordem de chegada e com
+        # tamanho limitado (as mais antigas são descartadas primeiro)
+        self.semiabertas = OrderedDict()
+        self.time_wait = OrderedDict()
         self.callback = None
+        # Se a rede aceitar um Pacote, o IP e o enlace escrevem os seus
+        # cabeçalhos na folga dele, sem copiar o segmento
+        self._enviar_pacote = getattr(rede, 'enviar_pacote', None)
         self.rede.registrar_recebedor(self._rdt_rcv)
 
     def registrar_monitor_de_conexoes_aceitas(self, callback):
         self.callback = callback
 
+    def _enviar(self, segmento, dest_addr):
+        """
+        Entrega à rede um segmento já com checksum.
+        """
+        if self._enviar_pacote is not None:
+            self._enviar_pacote(segmento, dest_addr)
+        else:
+            self.rede.enviar(bytes(segmento), dest_addr)
+
     def _rdt_rcv(self, src_addr, dst_addr, segment):
         src_port, dst_port, seq_no, ack_no, \
-            flags, window_size, checksum, urg_ptr = read_header(segment)
+            flags, window_size, checksum, urg_ptr = ler_tcp(segment)
 
         if dst_port != self.porta:
             return
         if not self.rede.ignore_checksum and calc_checksum(segment, src_addr, dst_addr) != 0:
             return
 
-        payload = segment[4*(flags>>12):]
+        tamanho_cabecalho = 4*(flags>>12)
+        payload = segment[tamanho_cabecalho:]
+        opcoes = ler_opcoes(segment[20:tamanho_cabecalho]) if tamanho_cabecalho > 20 else {}
         id_conexao = (src_addr, src_port, dst_addr, dst_port)
 
         if (flags & FLAGS_SYN) == FLAGS_SYN:
-            if id_conexao in self.conexoes and self.conexoes[id_conexao].closed:
-                del self.conexoes[id_conexao]
-
-            if id_conexao not in self.conexoes:
-                conexao = self.conexoes[id_conexao] = Conexao(
-                    self, id_conexao, seq_no + 1
-                )
-                conexao.srv_seq = random.randint(0, 0xffffffff)
-                conexao.ack_no_expected_from_client = seq_no + 1 
-
-                synack_flags = FLAGS_SYN | FLAGS_ACK
-                synack_seg = make_header(
-                    self.porta, src_port, conexao.srv_seq, conexao.ack_no_expected_from_client, synack_flags
-                )
-                synack_seg = fix_checksum(synack_seg, dst_addr, src_addr)
-                self.rede.enviar(synack_seg, src_addr)
-                
-                conexao.srv_seq += 1 
-                conexao.env_base = conexao.srv_seq 
-                
-                if self.callback:
-                    self.callback(conexao)
+            self._receber_syn(id_conexao, seq_no, window_size, opcoes)
             return
 
-        if id_conexao in self.conexoes:
-            self.conexoes[id_conexao]._rdt_rcv(seq_no, ack_no, flags, payload)
-        else:
-            pass
+        conexao = self.conexoes.get(id_conexao)
+        if conexao is None and (flags & FLAGS_ACK) and id_conexao in self.semiabertas and \
+                ack_no == self.semiabertas[id_conexao].iss + 1:
+            # ACK final do handshake (ou dados que chegaram antes dele)
+            semiaberta = self.semiabertas.pop(id_conexao)
+            if self.max_conexoes is not None and len(self.conexoes) >= self.max_conexoes:
+                return
+            conexao = self._estabelecer(id_conexao, semiaberta)
+        if conexao is not None:
+            conexao._rdt_rcv(seq_no, ack_no, flags, payload, opcoes, window_size)
+        elif (flags & FLAGS_FIN) and id_conexao in self.time_wait:
+            # O cliente não recebeu o ACK do seu FIN: reconhece de novo
+            seq, ack, _ = self.time_wait[id_conexao]
+            segmento = montar_cabecalho(self.porta, src_port, seq, ack, FLAGS_ACK)
+            self._enviar(fechar_segmento(segmento, dst_addr, src_addr), src_addr)
+
+    def _receber_syn(self, id_conexao, seq_no, window_size, opcoes):
+        conexao = self.conexoes.get(id_conexao)
+        if conexao is not None:
+            if not conexao.closed:
+                return
+            del self.conexoes[id_conexao]
+        self.time_wait.pop(id_conexao, None)
+
+        semiaberta = self.semiabertas.get(id_conexao)
+        if semiaberta is None or semiaberta.seq_cliente != seq_no:
+            # As semiabertas também contam, pois cada uma vira uma conexão
+            # quando o ACK final chegar (a que este SYN substitui não conta)
+            if self.max_conexoes is not None and \
+                    len(self.conexoes) + len(self.semiabertas) - (semiaberta is not None) >= \
+                    self.max_conexoes:
+                return
+            if len(self.semiabertas) >= MAX_SEMIABERTAS:
+                self.semiabertas.popitem(last=False)
+            semiaberta = self.semiabertas[id_conexao] = SemiAberta(seq_no, window_size, opcoes)
+        # Um SYN repetido indica que o SYN-ACK se perdeu: manda de novo
+        self._enviar_synack(id_conexao, semiaberta)
+        self._agendar_coleta()
+
+    def _enviar_synack(self, id_conexao, semiaberta):
+        src_addr, src_port, dst_addr, dst_port = id_conexao
+        # Só usamos SACK, escala de janela e timestamps se o cliente também
+        # os suportar
+        opcoes = b''
+        if semiaberta.ts_recente is not None:
+            opcoes = opcao_ts(relogio_ts(), semiaberta.ts_recente)
+        synack_opcoes = []
+        if semiaberta.sack:
+            synack_opcoes.append(bytes([TCPOPT_SACK_PERMITTED, 2]))
+        if semiaberta.escala is not None:
+            synack_opcoes.append(bytes([TCPOPT_WSCALE, 3, self.escala_recepcao]))
+
+        # A janela de um SYN nunca é escalada (RFC 7323, seção 2.2)
+        synack_seg = montar_cabecalho(
+            self.porta, src_port, semiaberta.iss, semiaberta.seq_cliente + 1, FLAGS_SYN | FLAGS_ACK,
+            opcoes + montar_opcoes(*synack_opcoes), self.buffer_recepcao
+        )
+        self._enviar(fechar_segmento(synack_seg, dst_addr, src_addr), src_addr)
+
+    def _estabelecer(self, id_conexao, semiaberta):
+        """
+        Cria a Conexao com o que foi negociado no handshake.
+        """
+        conexao = self.conexoes[id_conexao] = Conexao(
+            self, id_conexao, semiaberta.seq_cliente + 1
+        )
+        conexao.srv_seq = semiaberta.iss + 1
+        conexao.env_base = conexao.srv_seq
+        conexao.ack_no_expected_from_client = semiaberta.seq_cliente + 1
+        conexao.janela_cliente = semiaberta.janela
+        conexao.wl1 = semiaberta.seq_cliente
+        conexao.sack_permitido = semiaberta.sack
+        if semiaberta.escala is not None:
+            conexao.escala_cliente = semiaberta.escala
+            conexao.escala_envio = self.escala_recepcao
+        if semiaberta.ts_recente is not None:
+            conexao.timestamps = True
+            conexao.ts_recente = semiaberta.ts_recente
+            conexao.mss = MSS - TAMANHO_OPCAO_TS
+        if self.tempo_ocioso is not None:
+            conexao._agendar_ocioso()
+
+        if self.callback:
+            self.callback(conexao)
+        return conexao
+
+    def _entrar_time_wait(self, conexao):
+        """
+        Guarda o mínimo de uma conexão que fechamos primeiro para poder
+        reconhecer de novo o FIN do cliente, caso o nosso ACK se perca.
+        """
+        if len(self.time_wait) >= MAX_TIME_WAIT:
+            self.time_wait.popitem(last=False)
+        self.time_wait[conexao.id_conexao] = (conexao.srv_seq, conexao.next_seq_no_to_receive,
+                                              time.monotonic())
+        self._agendar_coleta()
+
+    def _agendar_coleta(self):
+        if not self._timer_coleta.ativo:
+            self._timer_coleta.agendar(INTERVALO_COLETA)
+
+    def _coletar(self):
+        """
+        Descarta conexões semiabertas e em TIME_WAIT antigas. As duas
+        tabelas estão em ordem de chegada, então só as entradas vencidas
+        do começo são visitadas. (Conexões em FIN_WAIT_2 e ociosas são
+        descartadas pelos seus próprios temporizadores, vide
+        Conexao._agendar_ocioso.)
+        """
+        agora = time.monotonic()
+        semiabertas = self.semiabertas
+        while semiabertas and agora - next(iter(semiabertas.values())).instante > TEMPO_SEMIABERTA:
+            semiabertas.popitem(last=False)
+        time_wait = self.time_wait
+        while time_wait and agora - next(iter(time_wait.values()))[2] > TEMPO_TIME_WAIT:
+            time_wait.popitem(last=False)
+        if semiabertas or time_wait:
+            self._timer_coleta.agendar(INTERVALO_COLETA)
+
+
+class SemiAberta:
+    """
+    Conexão que recebeu o SYN mas ainda não o ACK final do handshake. Guarda
+    só o necessário para reenviar o SYN-ACK e para criar a Conexao depois,
+    para que uma enxurrada de SYNs não aloque conexões inteiras.
+    """
+    __slots__ = ('seq_cliente', 'iss', 'janela', 'sack', 'escala', 'ts_recente',
+                 'instante')
+
+    def __init__(self, seq_cliente, janela, opcoes):
+        self.seq_cliente = seq_cliente
+        self.iss = random.randint(0, 0xffffffff)
+        self.janela = janela
+        self.sack = TCPOPT_SACK_PERMITTED in opcoes
+        self.escala = None
+        if TCPOPT_WSCALE in opcoes and len(opcoes[TCPOPT_WSCALE]) == 1:
+            self.escala = min(opcoes[TCPOPT_WSCALE][0], 14)
+        self.ts_recente = None
+        if TCPOPT_TIMESTAMP in opcoes and len(opcoes[TCPOPT_TIMESTAMP]) == 8:
+            self.ts_recente = PALAVRA_DUPLA.unpack_from(opcoes[TCPOPT_TIMESTAMP])[0]
+        self.instante = time.monotonic()
+
+
+class BufferEnvio:
+    """
+    Buffer de envio formado por uma fila de pedaços (memoryviews) dos dados
+    passados a Conexao.enviar. Retirar o começo do buffer só fatia o primeiro
+    pedaço, sem copiar o restante dos dados; a cópia só acontece quando um
+    segmento precisa juntar mais de um pedaço.
+    """
+    __slots__ = ('_pedacos', '_tamanho')
+
+    def __init__(self):
+        self._pedacos = deque()
+        self._tamanho = 0
+
+    def __len__(self):
+        return self._tamanho
+
+    def adicionar(self, dados):
+        if not dados:
+            return
+        if not isinstance(dados, bytes):
+            # copia, pois a aplicação pode alterar os dados depois
+            dados = bytes(dados)
+        self._pedacos.append(memoryview(dados))
+        self._tamanho += len(dados)
+
+    def retirar(self, n):
+        """
+        Retira até n bytes do começo do buffer.
+        """
+        pedacos = self._pedacos
+        partes = []
+        falta = n
+        while falta > 0 and pedacos:
+            pedaco = pedacos[0]
+            if len(pedaco) <= falta:
+                pedacos.popleft()
+                falta -= len(pedaco)
+            else:
+                pedacos[0] = pedaco[falta:]
+                pedaco = pedaco[:falta]
+                falta = 0
+            partes.append(pedaco)
+        self._tamanho -= n - falta
+        if len(partes) == 1:
+            return partes[0]
+        return b''.join(partes)
+
+
+class SegmentoPendente:
+    """
+    Segmento enviado e ainda não reconhecido. O número de sequência logo após
+    o segmento (seq_fim) é calculado no envio, para que um ACK cumulativo só
+    precise comparar inteiros.
+    """
+    __slots__ = ('seq', 'seq_fim', 'segmento', 't_envio', 'retransmitido',
+                 'confirmado_sack')
+
+    def __init__(self, seq, seq_fim, segmento, t_envio):
+        self.seq = seq
+        self.seq_fim = seq_fim
+        self.segmento = segmento
+        self.t_envio = t_envio
+        self.retransmitido = False
+        self.confirmado_sack = False
+
+
+class FilaRemontagem:
+    """
+    Segmentos recebidos fora de ordem, guardados até que a lacuna antes deles
+    seja preenchida. Os dados ficam em um dicionário indexado pelo número de
+    sequência, e um heap com esses números permite retirar sempre o menor.
+    O total guardado é limitado a limite bytes.
+    """
+    __slots__ = ('limite', 'bytes', '_segmentos', '_heap', '_ultimo')
+
+    def __init__(self, limite=8*MSS):
+        self.limite = limite
+        self.bytes = 0
+        self._segmentos = {}
+        self._heap = []
+        self._ultimo = None
+
+    def __len__(self):
+        return len(self._segmentos)
+
+    def blocos(self, maximo=MAX_BLOCOS_SACK):
+        """
+        Intervalos [inicio, fim) contíguos que estão guardados, para informar
+        ao transmissor via SACK. O primeiro bloco é o que contém o segmento
+        recebido por último, como pede a RFC 2018.
+        """
+        blocos = []
+        for seq in sorted(self._segmentos):
+            fim = seq + len(self._segmentos[seq])
+            if blocos and seq <= blocos[-1][1]:
+                blocos[-1][1] = max(blocos[-1][1], fim)
+            else:
+                blocos.append([seq, fim])
+        blocos.reverse()
+        for i, (inicio, fim) in enumerate(blocos):
+            if inicio <= self._ultimo < fim:
+                blocos.insert(0, blocos.pop(i))
+                break
+        return [tuple(bloco) for bloco in blocos[:maximo]]
+
+    def inserir(self, seq, dados):
+        """
+        Guarda dados, que começam no número de sequência seq. Retorna False
+        se não houver espaço para eles.
+        """
+        anterior = self._segmentos.get(seq)
+        if anterior is not None and len(anterior) >= len(dados):
+            # Duplicata: o primeiro bloco SACK ainda deve contê-la
+            self._ultimo = seq
+            return True
+        tamanho_anterior = 0 if anterior is None else len(anterior)
+        if self.bytes - tamanho_anterior + len(dados) > self.limite:
+            return False
+        self._segmentos[seq] = bytes(dados)
+        self._ultimo = seq
+        self.bytes += len(dados) - tamanho_anterior
+        if anterior is None:
+            heapq.heappush(self._heap, seq)
+        return True
+
+    def retirar_contiguos(self, proximo):
+        """
+        Retira os dados que continuam a sequência a partir de proximo,
+        descartando o que já foi recebido. Retorna a lista dos pedaços
+        retirados e o novo próximo número de sequência esperado.
+        """
+        heap = self._heap
+        segmentos = self._segmentos
+        partes = []
+        while heap and heap[0] <= proximo:
+            seq = heapq.heappop(heap)
+            dados = segmentos.pop(seq)
+            self.bytes -= len(dados)
+            fim = seq + len(dados)
+            if fim > proximo:
+                partes.append(dados[proximo - seq:])
+                proximo = fim
+        return partes, proximo
 
 
 class Conexao:
+    # Com milhares de conexões quase sempre ociosas, cada byte por conexão
+    # conta: os atributos ficam em slots, e buffers, filas, temporizadores e
+    # o controlador de congestionamento só são alocados quando usados (e os
+    # buffers e temporizadores são liberados de novo quando esvaziam). O
+    # estado da aplicação fica em dados_app.
+    __slots__ = (
+        'servidor', 'id_conexao', 'callback', 'dados_app',
+        'srv_seq', 'ack_no_expected_from_client', 'next_seq_no_to_receive',
+        'cli_addr', 'cli_port', 'srv_addr', 'srv_port',
+        'send_buffer', 'unacked_segments', 'env_base', 'timer', 'TimeoutInterval',
+        'EstimatedRTT', 'DevRTT', 'timestamps', 'ts_recente', 'mss',
+        '_cc', 'bytes_in_flight', 'duplicate_ack_count',
+        'closed', 'fin_sent', 'ultima_atividade', 'retransmissoes', 'fin_pendente',
+        'nagle', 'tampada', 'fin_received', 'fila_remontagem', 'seq_fin_cliente',
+        'sack_permitido', 'maior_sack', 'recuperacao_ate',
+        'timer_ack', 'segmentos_sem_ack', 'ultimo_ack_enviado',
+        'janela_cliente', 'escala_cliente', 'wl1', 'wl2',
+        'timer_persistencia', 'intervalo_persistencia', 'timer_ocioso',
+        'escala_envio', 'borda_anunciada', 'leitura_pausada', 'fila_recepcao',
+        'bytes_recepcao',
+    )
+
     def __init__(self, servidor, id_conexao, expected_seq_no_from_client):
         self.servidor = servidor
         self.id_conexao = id_conexao
         self.callback = None
+        # Livre para a aplicação guardar o seu estado da conexão
+        self.dados_app = None
         
         self.srv_seq = 0 
         self.ack_no_expected_from_client = 0 
@@ -69,47 +542,112 @@ class Conexao:
         
         self.cli_addr, self.cli_port, self.srv_addr, self.srv_port = id_conexao
         
-        self.send_buffer = b''
-        self.unacked_segments = []
+        # BufferEnvio, criado no primeiro enviar(); a fila de segmentos
+        # pendentes é uma tupla vazia enquanto não há nada em voo
+        self.send_buffer = None
+        self.unacked_segments = ()
         
         self.env_base = 0 
         self.timer = None
         self.TimeoutInterval = 1.0 
         
+        # Sem amostras de RTT ainda
         self.EstimatedRTT = None
         self.DevRTT = None
-        self.first_rtt_measurement = True
 
-        self.cwnd = float(MSS) 
-        self.ssthresh = float(65535) 
+        # Timestamps (RFC 7323), negociados no handshake. ts_recente é o
+        # TSval do cliente que ecoamos no TSecr dos nossos segmentos.
+        self.timestamps = False
+        self.ts_recente = 0
+        # Bytes de dados por segmento, descontadas as opções fixas
+        self.mss = MSS
+
+        # cwnd e ssthresh ficam no controlador de congestionamento, criado
+        # quando a conexão envia dados pela primeira vez (vide cc)
+        self._cc = None
         self.bytes_in_flight = 0.0
-        self.acked_bytes_towards_cwnd_increase = 0.0 
         self.duplicate_ack_count = 0
 
         self.closed = False
         self.fin_sent = False
+        self.ultima_atividade = time.monotonic()
+        # Retransmissões (ou sondas de janela) seguidas sem resposta
+        self.retransmissoes = 0
+        # fechar() foi chamado, mas o FIN espera o buffer de envio esvaziar
+        self.fin_pendente = False
+
+        # Agrupamento de escritas pequenas: algoritmo de Nagle (RFC 896)
+        # e tampar()/destampar()
+        self.nagle = False
+        self.tampada = False
         self.fin_received = False
+        # FilaRemontagem, criada quando chega o primeiro segmento fora de
+        # ordem
+        self.fila_remontagem = None
+        # Número de sequência do FIN do cliente, se ele chegou fora de ordem
+        self.seq_fin_cliente = None
+
+        # SACK (RFC 2018), negociado no handshake
+        self.sack_permitido = False
+        self.maior_sack = 0
+        self.recuperacao_ate = None
+
+        # ACK atrasado
+        self.timer_ack = None
+        self.segmentos_sem_ack = 0
+        self.ultimo_ack_enviado = None
+
+        # Controle de fluxo. janela_cliente é a janela anunciada pelo
+        # cliente (já multiplicada pela escala), atualizada só por segmentos
+        # mais novos que os que a atualizaram antes (wl1/wl2, RFC 793).
+        self.janela_cliente = 8*MSS
+        self.escala_cliente = 0
+        self.wl1 = 0
+        self.wl2 = 0
+        self.timer_persistencia = None
+        self.intervalo_persistencia = None
+        # Descarte de conexões em FIN_WAIT_2 ou ociosas (vide _agendar_ocioso)
+        self.timer_ocioso = None
+        # Do nosso lado, a janela anunciada é o espaço livre no buffer de
+        # recepção, que só enche enquanto a aplicação pausa a leitura
+        self.escala_envio = 0
+        self.borda_anunciada = None
+        self.leitura_pausada = False
+        self.fila_recepcao = ()
+        self.bytes_recepcao = 0
+
+    @property
+    def cc(self):
+        if self._cc is None:
+            self._cc = self.servidor.controle_congestionamento(mss=self.mss)
+        return self._cc
 
     def _start_timer(self):
-        self._stop_timer()
         if not self.unacked_segments or self.closed:
+            self._stop_timer()
             return
-        loop = asyncio.get_event_loop()
-        self.timer = loop.call_later(self.TimeoutInterval, self._timeout)
+        if self.timer is None:
+            self.timer = self.servidor.roda.criar(self._timeout)
+        self.timer.agendar(self.TimeoutInterval)
 
     def _stop_timer(self):
-        if self.timer:
-            self.timer.cancel()
+        if self.timer is not None:
+            self.timer.cancelar()
             self.timer = None
 
-    def _update_rtt(self, sample_rtt):
-        if self.first_rtt_measurement:
+    def _update_rtt(self, sample_rtt, amostras_esperadas=1):
+        """
+        Atualiza o RTO (RFC 6298). Com timestamps há uma amostra por ACK,
+        e não uma por janela, então os pesos são divididos pelo número de
+        amostras esperadas por RTT (RFC 7323, apêndice G) para que o
+        estimador não esqueça o histórico rápido demais.
+        """
+        if self.EstimatedRTT is None:
             self.EstimatedRTT = sample_rtt
             self.DevRTT = sample_rtt / 2.0
-            self.first_rtt_measurement = False
         else:
-            alpha = 0.125
-            beta = 0.25
+            alpha = 0.125 / amostras_esperadas
+            beta = 0.25 / amostras_esperadas
             self.DevRTT = (1 - beta) * self.DevRTT + beta * abs(sample_rtt - self.EstimatedRTT)
             self.EstimatedRTT = (1 - alpha) * self.EstimatedRTT + alpha * sample_rtt
         
@@ -118,116 +656,263 @@ class Conexao:
 
     def _timeout(self):
         if not self.unacked_segments or self.closed:
-            self.timer = None 
             return
+
+        self.retransmissoes += 1
+        if self.retransmissoes > MAX_RETRANSMISSOES:
+            self._abortar()
+            return
+        # Backoff exponencial (RFC 6298, 5.5), até a próxima amostra de RTT
+        self.TimeoutInterval = min(2 * self.TimeoutInterval, RTO_MAXIMO)
         
-        ssthresh_candidate = self.bytes_in_flight if self.bytes_in_flight > 0 else self.cwnd
-        self.ssthresh = max(ssthresh_candidate / 2.0, float(MSS)) 
-                                                                    
-        self.cwnd = float(MSS) 
+        self.cc.on_timeout(self._bytes_em_voo())
         self.duplicate_ack_count = 0
-        self.acked_bytes_towards_cwnd_increase = 0.0
 
-        seq, segment_to_retransmit, _, _ = self.unacked_segments[0]
-        self.unacked_segments[0] = (seq, segment_to_retransmit, time.time(), True)
-        self.servidor.rede.enviar(segment_to_retransmit, self.cli_addr)
+        # Depois de um timeout, a informação de SACK recebida é descartada,
+        # pois o receptor pode ter descartado os dados (RFC 2018, seção 8)
+        for pendente in self.unacked_segments:
+            pendente.confirmado_sack = False
+        self.maior_sack = self.env_base
+        self.recuperacao_ate = None
+
+        self._retransmitir(self.unacked_segments[0])
         self._start_timer()
 
-    def _rdt_rcv(self, seq_no_cli, ack_no_cli, flags, payload):
+    def _bytes_em_voo(self):
+        return self.bytes_in_flight if self.bytes_in_flight > 0 else self.cc.cwnd
+
+    def _retransmitir(self, pendente):
+        pendente.t_envio = time.monotonic_ns()
+        pendente.retransmitido = True
+        if self.timestamps:
+            # A retransmissão leva o TSval atual, para que o eco dela no
+            # ACK dê uma amostra de RTT válida (RFC 7323, seção 4.1)
+            # (o segmento guardado é alterado no lugar, sem cópia)
+            segmento = pendente.segmento.dados()
+            PAR.pack_into(segmento, 24, relogio_ts(), self.ts_recente)
+            PALAVRA.pack_into(segmento, CHECKSUM_TCP, 0)
+            preencher_checksum(segmento, self.srv_addr, self.cli_addr)
+        self.servidor._enviar(pendente.segmento, self.cli_addr)
+
+    def _marcar_sack(self, blocos):
+        """
+        Marca no placar os segmentos pendentes cobertos por blocos SACK.
+        Blocos fora da janela de envio (já reconhecidos ou além do que foi
+        enviado) são ignorados.
+        """
+        for inicio, fim in blocos:
+            if not (self.env_base <= inicio < fim <= self.srv_seq):
+                continue
+            if fim > self.maior_sack:
+                self.maior_sack = fim
+            for pendente in self.unacked_segments:
+                if pendente.seq >= fim:
+                    break
+                if inicio <= pendente.seq and pendente.seq_fim <= fim:
+                    pendente.confirmado_sack = True
+
+    def _pipe(self):
+        """
+        Estimativa dos bytes que ainda estão na rede (o "pipe" da RFC 6675):
+        os pendentes, menos os confirmados por SACK e menos as lacunas
+        (seguidas de dados confirmados) que ainda não foram retransmitidas,
+        que são consideradas perdidas.
+        """
+        pipe = 0
+        for pendente in self.unacked_segments:
+            if pendente.confirmado_sack:
+                continue
+            if pendente.seq < self.maior_sack and not pendente.retransmitido:
+                continue
+            pipe += pendente.seq_fim - pendente.seq
+        return pipe
+
+    def _retransmitir_lacunas(self):
+        """
+        Retransmite os segmentos que, pelo placar do SACK, o cliente ainda
+        não recebeu, mas que já foram seguidos por dados que ele recebeu.
+        Só retransmite o que cabe na janela de congestionamento descontado
+        o pipe; as demais lacunas saem conforme chegam novos ACKs.
+
+        O pipe já desconta os segmentos confirmados por SACK, então ele é
+        comparado com a janela sem a inflação dos ACKs duplicados (que
+        contaria os mesmos segmentos duas vezes), ou seja, com o ssthresh
+        da recuperação (RFC 6675, seção 5).
+        """
+        pipe = self._pipe()
+        cwnd = min(self.cc.cwnd, self.cc.ssthresh)
+        for pendente in self.unacked_segments:
+            if pendente.seq >= self.maior_sack:
+                break
+            if not pendente.confirmado_sack and not pendente.retransmitido:
+                tamanho = pendente.seq_fim - pendente.seq
+                if pipe + tamanho > cwnd:
+                    break
+                self._retransmitir(pendente)
+                pipe += tamanho
+
+    def _rdt_rcv(self, seq_no_cli, ack_no_cli, flags, payload, opcoes=None, janela=None):
         if self.closed:
             return
+        self.ultima_atividade = time.monotonic()
+        if self.timer_persistencia is not None:
+            # O cliente está respondendo às sondas de janela
+            self.retransmissoes = 0
+
+        if self.sack_permitido and opcoes and TCPOPT_SACK in opcoes and (flags & FLAGS_ACK):
+            self._marcar_sack(ler_blocos_sack(opcoes[TCPOPT_SACK]))
+
+        tsecr = None
+        if self.timestamps and opcoes and TCPOPT_TIMESTAMP in opcoes and \
+                len(opcoes[TCPOPT_TIMESTAMP]) == 8:
+            tsval, tsecr = PAR.unpack(opcoes[TCPOPT_TIMESTAMP])
+            # Só ecoamos o TSval de segmentos que não estão além do que já
+            # reconhecemos, e nunca um TSval mais antigo (RFC 7323, 4.3)
+            if (self.ultimo_ack_enviado is None or seq_no_cli <= self.ultimo_ack_enviado) and \
+                    (tsval - self.ts_recente) & 0xffffffff < 0x80000000:
+                self.ts_recente = tsval
+
+        janela_anterior = self.janela_cliente
+        if janela is not None and (flags & FLAGS_ACK) and \
+                self.env_base <= ack_no_cli <= self.srv_seq and \
+                (self.wl1 < seq_no_cli or (self.wl1 == seq_no_cli and self.wl2 <= ack_no_cli)):
+            self.janela_cliente = janela << self.escala_cliente
+            self.wl1 = seq_no_cli
+            self.wl2 = ack_no_cli
 
         process_payload_for_app = (len(payload) > 0) and (not self.fin_received)
 
         is_control_or_data = len(payload) > 0 or (flags & FLAGS_FIN)
         if is_control_or_data:
-            if seq_no_cli < self.next_seq_no_to_receive:
+            if seq_no_cli + len(payload) <= self.next_seq_no_to_receive and seq_no_cli < self.next_seq_no_to_receive:
                 self._send_ack()
                 if not (flags & FLAGS_ACK): return
             elif seq_no_cli > self.next_seq_no_to_receive:
+                # Fora de ordem: guarda os dados (se couberem na janela) e
+                # manda um ACK duplicado (que já informa os blocos SACK, se
+                # for o caso)
+                if process_payload_for_app and \
+                        seq_no_cli + len(payload) <= self.next_seq_no_to_receive + self._espaco_recepcao():
+                    if self.fila_remontagem is None:
+                        self.fila_remontagem = FilaRemontagem(self.servidor.buffer_recepcao)
+                    self.fila_remontagem.inserir(seq_no_cli, payload)
                 self._send_ack()
                 if not (flags & FLAGS_ACK): return
+            elif len(payload) > self._espaco_recepcao():
+                # Só aceita o que cabe no buffer de recepção (nada, se a
+                # janela estiver fechada); o cliente retransmite o resto
+                payload = payload[:self._espaco_recepcao()]
+                flags &= ~FLAGS_FIN
+                if not payload:
+                    process_payload_for_app = False
+                    self._send_ack()
         
         if (flags & FLAGS_ACK):
-            if self.fin_sent and ack_no_cli == self.srv_seq:
-                if self.fin_received:
-                    self._handle_connection_termination()
-            
-            elif ack_no_cli > self.env_base: 
+            if ack_no_cli > self.env_base: 
                 bytes_realmente_novos_reconhecidos = float(ack_no_cli - self.env_base)
+                amostras_esperadas = max(1, int(self.bytes_in_flight + 2*MSS - 1) // (2*MSS))
                 
                 self.bytes_in_flight -= bytes_realmente_novos_reconhecidos
                 self.bytes_in_flight = max(0.0, self.bytes_in_flight)
 
+                # Os segmentos estão em ordem de sequência, então basta
+                # retirar do começo da fila os que o ACK cobre por inteiro.
                 acked_original_send_time = None
-                is_retransmitted_acked = True 
-                new_unacked_list = []
-                processed_ack_for_rtt = False
-                for seq, seg, t_envio, retransmitted_flag in self.unacked_segments:
-                    seg_hdr_len = 4*(read_header(seg)[4]>>12)
-                    seg_payload_len = len(seg[seg_hdr_len:])
-                    seg_consumes_seq = seg_payload_len
-                    if (read_header(seg)[4] & FLAGS_FIN or read_header(seg)[4] & FLAGS_SYN):
-                        seg_consumes_seq +=1
-                    
-                    if seq + seg_consumes_seq <= ack_no_cli:
-                        if not retransmitted_flag and not processed_ack_for_rtt:
-                            acked_original_send_time = t_envio
-                            is_retransmitted_acked = False
-                            processed_ack_for_rtt = True 
-                    else:
-                        new_unacked_list.append((seq, seg, t_envio, retransmitted_flag))
-                self.unacked_segments = new_unacked_list
-                
-                if acked_original_send_time and not is_retransmitted_acked:
-                    sample_rtt = time.time() - acked_original_send_time
+                sample_rtt = None
+                pendentes = self.unacked_segments
+                while pendentes and pendentes[0].seq_fim <= ack_no_cli:
+                    pendente = pendentes.popleft()
+                    if not pendente.retransmitido and acked_original_send_time is None:
+                        acked_original_send_time = pendente.t_envio
+                if not pendentes:
+                    self.unacked_segments = ()
+
+                if tsecr is not None:
+                    # O TSecr ecoa o instante de envio do segmento que gerou
+                    # o ACK, mesmo que seja uma retransmissão
+                    sample_rtt = ((relogio_ts() - tsecr) & 0xffffffff) / 1000.0
+                    self._update_rtt(sample_rtt, amostras_esperadas)
+                elif acked_original_send_time is not None:
+                    sample_rtt = (time.monotonic_ns() - acked_original_send_time) / 1e9
                     self._update_rtt(sample_rtt)
 
                 self.env_base = ack_no_cli
                 self.duplicate_ack_count = 0 
+                self.retransmissoes = 0
 
-                self.acked_bytes_towards_cwnd_increase += bytes_realmente_novos_reconhecidos
-                
-                while self.acked_bytes_towards_cwnd_increase >= self.cwnd:
-                    cwnd_valor_usado_para_credito = self.cwnd
-                    self.cwnd += float(MSS)
-                    self.acked_bytes_towards_cwnd_increase -= cwnd_valor_usado_para_credito
-                    if self.acked_bytes_towards_cwnd_increase < 0:
-                        self.acked_bytes_towards_cwnd_increase = 0.0
-                    
-                    if self.cwnd > self.ssthresh and cwnd_valor_usado_para_credito < self.ssthresh:
-                        self.acked_bytes_towards_cwnd_increase = 0.0 
-                        break
+                if self.recuperacao_ate is None:
+                    self.cc.on_ack(bytes_realmente_novos_reconhecidos, sample_rtt)
+                elif ack_no_cli >= self.recuperacao_ate:
+                    # Tudo o que foi enviado até a perda foi reconhecido
+                    self.recuperacao_ate = None
+                    self.cc.on_recovery_exit(self.bytes_in_flight)
+                else:
+                    # ACK parcial: ainda há lacunas a retransmitir
+                    self.cc.on_partial_ack(bytes_realmente_novos_reconhecidos)
+                    if self.sack_permitido:
+                        self._retransmitir_lacunas()
+                    elif self.unacked_segments:
+                        self._retransmitir(self.unacked_segments[0])
                 
                 if not self.unacked_segments:
                     self._stop_timer()
+                    if self._em_fin_wait_2():
+                        self._agendar_ocioso()
                 else:
                     self._start_timer()
                 
                 self._try_send_buffered_data()
 
-            elif ack_no_cli == self.env_base and len(payload) == 0 and not (flags & FLAGS_SYN or flags & FLAGS_FIN):
+            elif ack_no_cli == self.env_base and len(payload) == 0 and not (flags & FLAGS_SYN or flags & FLAGS_FIN) \
+                    and self.janela_cliente == janela_anterior:
                 if not (self.fin_sent and ack_no_cli == self.srv_seq):
                     self.duplicate_ack_count += 1
-                    if self.duplicate_ack_count == 3:
-                        ssthresh_candidate_fr = self.bytes_in_flight if self.bytes_in_flight > 0 else self.cwnd
-                        self.ssthresh = max(ssthresh_candidate_fr / 2.0, float(MSS))
-                        
-                        self.cwnd = self.ssthresh + 3.0 * MSS
-                        self.acked_bytes_towards_cwnd_increase = 0.0
-                        
+                    if self.duplicate_ack_count == 3 and self.recuperacao_ate is None:
+                        # Retransmissão rápida e entrada em recuperação rápida
+                        self.cc.on_loss(self._bytes_em_voo())
                         if self.unacked_segments:
-                            seq_to_retransmit, seg_to_retransmit, t_orig, _ = self.unacked_segments[0]
-                            self.unacked_segments[0] = (seq_to_retransmit, seg_to_retransmit, time.time(), True)
-                            self.servidor.rede.enviar(seg_to_retransmit, self.cli_addr)
+                            self.recuperacao_ate = self.srv_seq
+                            self._retransmitir(self.unacked_segments[0])
+                            if self.sack_permitido:
+                                self._retransmitir_lacunas()
                             self._start_timer()
+                    elif self.duplicate_ack_count > 3 and self.recuperacao_ate is not None:
+                        self.cc.on_dup_ack()
+                        if self.sack_permitido:
+                            self._retransmitir_lacunas()
+                        self._try_send_buffered_data()
+
+            if self.janela_cliente > janela_anterior:
+                # Atualização de janela: pode haver dados esperando por ela
+                self._try_send_buffered_data()
         
+            if self.fin_sent and self.fin_received and ack_no_cli == self.srv_seq:
+                # Nosso FIN foi reconhecido e o do cliente já tinha chegado
+                self._handle_connection_termination()
+                return
+
         if process_payload_for_app:
-            if seq_no_cli == self.next_seq_no_to_receive: 
+            if seq_no_cli < self.next_seq_no_to_receive < seq_no_cli + len(payload):
+                # Retransmissão que cobre dados já recebidos e dados novos
+                payload = payload[self.next_seq_no_to_receive - seq_no_cli:]
+                seq_no_cli = self.next_seq_no_to_receive
+            if seq_no_cli == self.next_seq_no_to_receive:
                 self.next_seq_no_to_receive += len(payload)
-                if self.callback:
-                    self.callback(self, payload)
-                self._send_ack() 
+                dados = bytes(payload)
+                partes = None
+                if self.fila_remontagem:
+                    # A lacuna foi preenchida: entrega de uma vez tudo o que
+                    # estava esperando por ela
+                    partes, self.next_seq_no_to_receive = \
+                        self.fila_remontagem.retirar_contiguos(self.next_seq_no_to_receive)
+                    if not self.fila_remontagem:
+                        self.fila_remontagem = None
+                    if partes:
+                        dados = b''.join([dados] + partes)
+                self._entregar(dados)
+                # Se uma lacuna foi preenchida (ou ainda há lacunas), o
+                # transmissor precisa saber logo; senão o ACK pode esperar
+                self._agendar_ack(imediato=bool(partes) or bool(self.fila_remontagem))
         elif len(payload) > 0 and self.fin_received :
              if seq_no_cli == self.next_seq_no_to_receive :
                   self.next_seq_no_to_receive += len(payload)
@@ -236,23 +921,109 @@ class Conexao:
                   self._send_ack()
 
         if (flags & FLAGS_FIN):
-            if seq_no_cli == self.next_seq_no_to_receive: 
-                self.next_seq_no_to_receive += 1
-                self.fin_received = True
-                if self.callback:
-                    self.callback(self, b'')
-                self._send_ack() 
-                if self.fin_sent:
-                    self._handle_connection_termination()
+            # O FIN ocupa o número de sequência logo após os dados do segmento
+            seq_fin = seq_no_cli + len(payload)
+            if seq_fin == self.next_seq_no_to_receive and not self.fin_received:
+                self._receber_fin()
+            elif seq_fin > self.next_seq_no_to_receive:
+                self.seq_fin_cliente = seq_fin
             elif seq_no_cli < self.next_seq_no_to_receive and self.fin_received :
                  self._send_ack()
+        elif self.seq_fin_cliente == self.next_seq_no_to_receive and not self.fin_received:
+            self._receber_fin()
+
+    def _receber_fin(self):
+        self.next_seq_no_to_receive += 1
+        self.fin_received = True
+        self._entregar(b'')
+        self._send_ack()
+        if self.fin_sent and not self.unacked_segments:
+            # Fechamos primeiro: o cliente ainda pode retransmitir o FIN
+            self.servidor._entrar_time_wait(self)
+            self._handle_connection_termination()
+
+    def _entregar(self, dados):
+        """
+        Entrega dados (ou b'' para o fim da conexão) à aplicação, ou os
+        guarda no buffer de recepção se a leitura estiver pausada.
+        """
+        if self.leitura_pausada or self.fila_recepcao:
+            if not self.fila_recepcao:
+                self.fila_recepcao = deque()
+            self.fila_recepcao.append(dados)
+            self.bytes_recepcao += len(dados)
+        elif self.callback:
+            self.callback(self, dados)
+
+    def _espaco_recepcao(self):
+        return max(self.servidor.buffer_recepcao - self.bytes_recepcao, 0)
+
+    def _janela_anunciada(self):
+        """
+        Janela a anunciar no próximo segmento, já deslocada pela escala.
+        Para evitar a síndrome da janela boba do lado do receptor (RFC 1122,
+        4.2.3.3), a borda direita só avança quando o espaço liberado chega a
+        um MSS (ou metade do buffer); e ela nunca recua.
+        """
+        borda = self.next_seq_no_to_receive + self._espaco_recepcao()
+        if self.borda_anunciada is not None and \
+                borda - self.borda_anunciada < min(self.servidor.buffer_recepcao // 2, MSS):
+            borda = max(self.borda_anunciada, self.next_seq_no_to_receive)
+        self.borda_anunciada = borda
+        return (borda - self.next_seq_no_to_receive) >> self.escala_envio
+
+    def _agendar_ack(self, imediato=False):
+        """
+        ACK atrasado (RFC 1122, 4.2.3.2): reconhece a cada dois segmentos ou
+        depois de ATRASO_ACK segundos. Se a aplicação respondeu dentro do
+        callback, o ACK já foi de carona no segmento de dados.
+        """
+        if self.closed or self.ultimo_ack_enviado == self.next_seq_no_to_receive:
+            return
+        self.segmentos_sem_ack += 1
+        if imediato or self.segmentos_sem_ack >= 2:
+            self._send_ack()
+        elif self.timer_ack is None:
+            self.timer_ack = self.servidor.roda.criar(self._ack_atrasado)
+            self.timer_ack.agendar(ATRASO_ACK)
+
+    def _ack_atrasado(self):
+        self.timer_ack = None
+        if self.ultimo_ack_enviado != self.next_seq_no_to_receive:
+            self._send_ack()
+
+    def _ack_enviado(self):
+        """
+        Registra que o cliente foi informado do next_seq_no_to_receive atual,
+        seja por um ACK puro, seja de carona em um segmento de dados.
+        """
+        self.ultimo_ack_enviado = self.next_seq_no_to_receive
+        self.segmentos_sem_ack = 0
+        if self.timer_ack is not None:
+            self.timer_ack.cancelar()
+            self.timer_ack = None
+
+    def _opcoes_ts(self):
+        """
+        Opção de timestamps para o próximo segmento (vazia se não foi
+        negociada). Ela sempre vai primeiro, para que o TSval fique na
+        mesma posição do cabeçalho e possa ser atualizado ao retransmitir.
+        """
+        if not self.timestamps:
+            return b''
+        return opcao_ts(relogio_ts(), self.ts_recente)
 
     def _send_ack(self):
         if self.closed:
             return
-        ack_segment = make_header(self.srv_port, self.cli_port, self.srv_seq, self.next_seq_no_to_receive, FLAGS_ACK)
-        ack_segment = fix_checksum(ack_segment, self.srv_addr, self.cli_addr)
-        self.servidor.rede.enviar(ack_segment, self.cli_addr)
+        self._ack_enviado()
+        opcoes = self._opcoes_ts()
+        if self.sack_permitido and self.fila_remontagem:
+            maximo = MAX_BLOCOS_SACK_COM_TS if self.timestamps else MAX_BLOCOS_SACK
+            opcoes += montar_opcoes(opcao_sack(self.fila_remontagem.blocos(maximo)))
+        ack_segment = montar_cabecalho(self.srv_port, self.cli_port, self.srv_seq, self.next_seq_no_to_receive, FLAGS_ACK, opcoes,
+                                       self._janela_anunciada())
+        self.servidor._enviar(fechar_segmento(ack_segment, self.srv_addr, self.cli_addr), self.cli_addr)
 
     def _send_segment(self, payload=b'', flags=0):
         if self.closed:
@@ -264,16 +1035,26 @@ class Conexao:
         if (flags & FLAGS_SYN) and not (flags & FLAGS_ACK):
             current_flags = FLAGS_SYN
         
-        header = make_header(self.srv_port, self.cli_port, seq_no_to_send, ack_no_in_header, current_flags)
-        segment = fix_checksum(header + payload, self.srv_addr, self.cli_addr)
+        # Cabeçalho, opções e dados vão direto para um único buffer, com
+        # folga para os cabeçalhos das camadas de baixo
+        segment = novo_segmento(self.srv_port, self.cli_port, seq_no_to_send, ack_no_in_header, current_flags,
+                                self._janela_anunciada(), self._opcoes_ts(), payload)
+        fechar_segmento(segment, self.srv_addr, self.cli_addr)
         
-        consumes_seq_no = len(payload) > 0 or (current_flags & FLAGS_SYN) or (current_flags & FLAGS_FIN)
+        seq_len = len(payload)
+        if (current_flags & FLAGS_SYN) or (current_flags & FLAGS_FIN):
+            seq_len += 1
+        consumes_seq_no = seq_len > 0
 
         if consumes_seq_no:
-            self.unacked_segments.append((seq_no_to_send, segment, time.time(), False))
+            if not self.unacked_segments:
+                self.unacked_segments = deque()
+            self.unacked_segments.append(SegmentoPendente(
+                seq_no_to_send, seq_no_to_send + seq_len, segment, time.monotonic_ns()))
             self.bytes_in_flight += len(payload)
 
-        self.servidor.rede.enviar(segment, self.cli_addr)
+        self.servidor._enviar(segment, self.cli_addr)
+        self._ack_enviado()
 
         if len(payload) > 0:
             self.srv_seq += len(payload)
@@ -286,37 +1067,214 @@ class Conexao:
     def _try_send_buffered_data(self):
         if self.closed: return
 
-        while len(self.send_buffer) > 0:
-            available_window_bytes = self.cwnd - self.bytes_in_flight
+        # Sem buffer alocado, () faz o papel de buffer vazio
+        buffer = self.send_buffer or ()
+        while len(buffer) > 0:
+            # Limitado tanto pela janela de congestionamento quanto pela
+            # janela anunciada pelo cliente
+            available_window_bytes = min(self.cc.cwnd - self.bytes_in_flight,
+                                         self.env_base + self.janela_cliente - self.srv_seq)
             if available_window_bytes < 1.0 :
                 break 
-            data_to_send_len = min(len(self.send_buffer), MSS) 
+            data_to_send_len = min(len(buffer), self.mss) 
+            if data_to_send_len < self.mss and not self.fin_pendente and \
+                    (self.tampada or (self.nagle and self.bytes_in_flight > 0)):
+                # Segura o resto até completar um segmento, até chegar o
+                # ACK do que está em voo (Nagle) ou até destampar()
+                break
+            if available_window_bytes < data_to_send_len and self.bytes_in_flight > 0:
+                # Evita a síndrome da janela boba: com uma cwnd fracionária,
+                # esperamos abrir espaço para um segmento cheio em vez de
+                # mandar um pedaço pequeno
+                break
             data_to_send_len = min(data_to_send_len, int(available_window_bytes))
             if data_to_send_len <= 0 :
                  break
-            payload_chunk = self.send_buffer[:data_to_send_len]
-            self.send_buffer = self.send_buffer[data_to_send_len:]
+            payload_chunk = buffer.retirar(data_to_send_len)
             self._send_segment(payload=payload_chunk, flags=FLAGS_ACK)
 
+        if not len(buffer):
+            self.send_buffer = None
+
+        if len(buffer) > 0 and not self.unacked_segments and \
+                self.env_base + self.janela_cliente - self.srv_seq <= 0:
+            # Janela zero e nada em voo: nenhum ACK vai chegar para nos
+            # avisar quando ela abrir, então sondamos o cliente
+            self._iniciar_persistencia()
+        else:
+            self._parar_persistencia()
+
+        if self.fin_pendente and not self.fin_sent and len(buffer) == 0:
+            self.fin_sent = True
+            self._send_segment(flags=FLAGS_FIN)
+
+    def _iniciar_persistencia(self):
+        if self.timer_persistencia is not None:
+            return
+        if self.intervalo_persistencia is None:
+            self.intervalo_persistencia = self.TimeoutInterval
+        self.timer_persistencia = self.servidor.roda.criar(self._sondar_janela)
+        self.timer_persistencia.agendar(self.intervalo_persistencia)
+
+    def _parar_persistencia(self):
+        if self.timer_persistencia is not None:
+            self.timer_persistencia.cancelar()
+            self.timer_persistencia = None
+        self.intervalo_persistencia = None
+
+    def _sondar_janela(self):
+        """
+        Sonda de janela zero: um ACK com número de sequência já reconhecido
+        obriga o cliente a responder com um ACK que traz a janela atual.
+        """
+        self.timer_persistencia = None
+        if self.closed:
+            return
+        self.retransmissoes += 1
+        if self.retransmissoes > MAX_RETRANSMISSOES:
+            self._abortar()
+            return
+        sonda = montar_cabecalho(self.srv_port, self.cli_port, self.srv_seq - 1,
+                                 self.next_seq_no_to_receive, FLAGS_ACK,
+                                 self._opcoes_ts(), self._janela_anunciada())
+        self.servidor._enviar(fechar_segmento(sonda, self.srv_addr, self.cli_addr), self.cli_addr)
+        # Backoff exponencial entre as sondas
+        self.intervalo_persistencia = min(2 * self.intervalo_persistencia, PERSISTENCIA_MAXIMA)
+        self._try_send_buffered_data()
+
     def registrar_recebedor(self, callback):
         self.callback = callback
 
+    def pausar_leitura(self):
+        """
+        Para de entregar dados à aplicação. O que chegar fica no buffer de
+        recepção e a janela anunciada diminui até fechar, fazendo o cliente
+        esperar em vez de o servidor acumular dados sem limite.
+        """
+        self.leitura_pausada = True
+
+    def retomar_leitura(self):
+        """
+        Entrega à aplicação o que ficou guardado no buffer de recepção e
+        avisa o cliente se a janela reabriu.
+        """
+        self.leitura_pausada = False
+        while self.fila_recepcao and not self.leitura_pausada:
+            dados = self.fila_recepcao.popleft()
+            self.bytes_recepcao -= len(dados)
+            if self.callback:
+                self.callback(self, dados)
+        if not self.fila_recepcao:
+            self.fila_recepcao = ()
+        if self.borda_anunciada is not None and \
+                self.next_seq_no_to_receive + self._espaco_recepcao() - self.borda_anunciada >= \
+                min(self.servidor.buffer_recepcao // 2, MSS):
+            self._send_ack()
+
+    def definir_nagle(self, ativo):
+        """
+        Liga ou desliga o algoritmo de Nagle: com ele ligado, um segmento
+        menor que o MSS só é enviado quando não há dados em voo.
+        """
+        self.nagle = ativo
+        if not ativo:
+            self._try_send_buffered_data()
+
+    def tampar(self):
+        """
+        Segura o envio de segmentos menores que o MSS até destampar() ser
+        chamado, para juntar várias escritas pequenas em poucos segmentos.
+        """
+        self.tampada = True
+
+    def destampar(self):
+        """
+        Volta a enviar normalmente, mandando o que ficou seguro por tampar().
+        """
+        self.tampada = False
+        self._try_send_buffered_data()
+
     def enviar(self, dados): 
-        if self.closed or self.fin_sent:
+        if self.closed or self.fin_pendente:
             return
-        self.send_buffer += dados
+        if self.send_buffer is None:
+            self.send_buffer = BufferEnvio()
+        self.send_buffer.adicionar(dados)
         self._try_send_buffered_data()
 
     def fechar(self): 
-        if self.fin_sent or self.closed:
+        if self.fin_pendente or self.closed:
             return
+        # O FIN só sai depois de todos os dados do buffer de envio
+        self.fin_pendente = True
         self._try_send_buffered_data() 
-        self.fin_sent = True
-        self._send_segment(flags=FLAGS_FIN)
+
+    def _em_fin_wait_2(self):
+        # Nosso FIN foi reconhecido, mas o cliente ainda não mandou o seu
+        return self.fin_sent and not self.fin_received and not self.unacked_segments
+
+    def _limite_ocioso(self):
+        """
+        Tempo sem receber nada depois do qual a conexão é descartada, ou
+        None se ela pode ficar parada indefinidamente.
+        """
+        limite = self.servidor.tempo_ocioso
+        if self._em_fin_wait_2():
+            # O cliente pode nunca mandar o seu FIN
+            limite = TEMPO_FIN_WAIT_2 if limite is None else min(limite, TEMPO_FIN_WAIT_2)
+        return limite
+
+    def _agendar_ocioso(self):
+        """
+        (Re)agenda a verificação de ociosidade para quando o limite vencer,
+        contado a partir da última atividade. O temporizador não é
+        reagendado a cada segmento recebido: quando expira,
+        _verificar_ocioso confere ultima_atividade e, se houve atividade
+        nesse meio tempo, agenda de novo.
+        """
+        limite = self._limite_ocioso()
+        if limite is None or self.closed:
+            if self.timer_ocioso is not None:
+                self.timer_ocioso.cancelar()
+                self.timer_ocioso = None
+            return
+        if self.timer_ocioso is None:
+            self.timer_ocioso = self.servidor.roda.criar(self._verificar_ocioso)
+        self.timer_ocioso.agendar(limite - (time.monotonic() - self.ultima_atividade))
+
+    def _verificar_ocioso(self):
+        if self.closed:
+            return
+        ocioso = time.monotonic() - self.ultima_atividade
+        if self._em_fin_wait_2() and ocioso >= TEMPO_FIN_WAIT_2:
+            self._handle_connection_termination()
+        elif self.servidor.tempo_ocioso is not None and ocioso >= self.servidor.tempo_ocioso:
+            self._abortar()
+        else:
+            self._agendar_ocioso()
+
+    def _abortar(self):
+        """
+        Encerra a conexão sem o fechamento normal, quando o cliente parou de
+        responder, e avisa a aplicação como se ele tivesse fechado.
+        """
+        if self.closed:
+            return
+        fin_recebido = self.fin_received
+        self._handle_connection_termination()
+        if not fin_recebido:
+            self._entregar(b'')
 
     def _handle_connection_termination(self):
         if not self.closed:
             self.closed = True
             self._stop_timer()
+            self._parar_persistencia()
+            if self.timer_ack is not None:
+                self.timer_ack.cancelar()
+                self.timer_ack = None
+            if self.timer_ocioso is not None:
+                self.timer_ocioso.cancelar()
+                self.timer_ocioso = None
             if self.id_conexao in self.servidor.conexoes and self.servidor.conexoes[self.id_conexao] is self:
                 del self.servidor.conexoes[self.id_conexao]
@@ -0,0 +1,183 @@
+# Roda de temporização hierárquica (Varghese e Lauck), compartilhada por
+# todas as conexões de um Servidor.
+#
+# Cada conexão reagenda o seu temporizador de retransmissão a cada envio e a
+# cada ACK. Com loop.call_later, cada reagendamento cancela um handle e
+# insere outro no heap do asyncio, que cresce com o número de conexões. Na
+# roda, um temporizador é só um elemento de um conjunto (o "slot" do instante
+# em que expira), então agendar e cancelar custam O(1), e o asyncio só
+# enxerga um único temporizador: o tique da própria roda.
+#
+# A roda tem NIVEIS níveis de TAMANHO_NIVEL slots. O nível 0 tem um slot
+# por tique; cada slot do nível n cobre TAMANHO_NIVEL**n tiques. Quando o
+# nível 0 dá uma volta completa, o próximo slot do nível 1 é "derramado"
+# nos níveis de baixo, e assim por diante.
+
+import asyncio
+import math
+import traceback
+
+# Duração de um tique, em segundos
+GRANULARIDADE = 0.01
+
+BITS_NIVEL = 6
+TAMANHO_NIVEL = 1 << BITS_NIVEL
+MASCARA_NIVEL = TAMANHO_NIVEL - 1
+NIVEIS = 4
+# Atraso máximo representável, em tiques (pouco mais de 46 horas); atrasos
+# maiores são truncados
+MAXIMO_TIQUES = (1 << (BITS_NIVEL * NIVEIS)) - 1
+
+
+class Temporizador:
+    """
+    Temporizador reutilizável: pode ser agendado, cancelado e reagendado
+    quantas vezes for preciso. Quando expira, chama callback().
+    """
+    __slots__ = ('roda', 'callback', 'expira', '_slot', '_nivel')
+
+    def __init__(self, roda, callback):
+        self.roda = roda
+        self.callback = callback
+        self.expira = 0
+        self._slot = None
+        self._nivel = 0
+
+    @property
+    def ativo(self):
+        return self._slot is not None
+
+    def __bool__(self):
+        return self._slot is not None
+
+    def agendar(self, atraso):
+        """
+        (Re)agenda o temporizador para expirar daqui a atraso segundos.
+        """
+        self.roda._agendar(self, atraso)
+
+    def cancelar(self):
+        if self._slot is not None:
+            self.roda._remover(self)
+
+
+class RodaTemporizacao:
+    def __init__(self, granularidade=GRANULARIDADE):
+        self.granularidade = granularidade
+        self.tique = 0
+        self._niveis = [[set() for _ in range(TAMANHO_NIVEL)] for _ in range(NIVEIS)]
+        self._quantidade = [0] * NIVEIS
+        self._origem = None
+        self._loop = None
+        self._handle = None
+        self._proximo = None
+
+    def __len__(self):
+        return sum(self._quantidade)
+
+    def criar(self, callback):
+        """
+        Cria um temporizador (ainda não agendado) ligado a esta roda.
+        """
+        return Temporizador(self, callback)
+
+    def _agora(self):
+        """
+        Número do tique correspondente ao instante atual.
+        """
+        return int((self._loop.time() - self._origem) / self.granularidade)
+
+    def _agendar(self, temporizador, atraso):
+        if temporizador._slot is not None:
+            self._remover(temporizador)
+        if self._loop is None:
+            self._loop = asyncio.get_event_loop()
+            self._origem = self._loop.time()
+        agora = self._agora()
+        if not len(self):
+            # Roda vazia: não há o que processar nos tiques perdidos
+            self.tique = agora
+        # A roda pode estar dormindo com self.tique atrasado, então o prazo
+        # é contado a partir do instante atual de verdade. O tique de
+        # expiração é arredondado para cima, para o temporizador nunca
+        # disparar antes do prazo.
+        expira = math.ceil((self._loop.time() - self._origem + atraso) / self.granularidade)
+        temporizador.expira = min(max(expira, agora + 1), agora + MAXIMO_TIQUES)
+        self._inserir(temporizador)
+        self._armar()
+
+    def _inserir(self, temporizador):
+        expira = max(temporizador.expira, self.tique + 1)
+        delta = expira - self.tique
+        nivel = 0
+        while nivel < NIVEIS - 1 and delta >= 1 << (BITS_NIVEL * (nivel + 1)):
+            nivel += 1
+        slot = self._niveis[nivel][(expira >> (BITS_NIVEL * nivel)) & MASCARA_NIVEL]
+        slot.add(temporizador)
+        temporizador._slot = slot
+        temporizador._nivel = nivel
+        self._quantidade[nivel] += 1
+
+    def _remover(self, temporizador):
+        temporizador._slot.discard(temporizador)
+        temporizador._slot = None
+        self._quantidade[temporizador._nivel] -= 1
+
+    def _derramar(self, nivel):
+        """
+        Redistribui nos níveis de baixo os temporizadores do slot atual do
+        nível dado. Retorna o índice desse slot.
+        """
+        indice = (self.tique >> (BITS_NIVEL * nivel)) & MASCARA_NIVEL
+        slot = self._niveis[nivel][indice]
+        self._niveis[nivel][indice] = set()
+        self._quantidade[nivel] -= len(slot)
+        for temporizador in slot:
+            self._inserir(temporizador)
+        return indice
+
+    def _armar(self):
+        """
+        Agenda o próximo tique no asyncio. Se o nível 0 estiver vazio, não
+        há nada a expirar antes do próximo derramamento, então a roda dorme
+        até lá em vez de acordar a cada tique.
+        """
+        if not len(self):
+            return
+        if self._quantidade[0]:
+            proximo = self.tique + 1
+        else:
+            proximo = (self.tique | MASCARA_NIVEL) + 1
+        if self._handle is not None:
+            if self._proximo <= proximo:
+                return
+            # Um temporizador novo expira antes do tique já agendado
+            self._handle.cancel()
+        atraso = self._origem + proximo * self.granularidade - self._loop.time()
+        self._handle = self._loop.call_later(max(atraso, 0), self._processar)
+        self._proximo = proximo
+
+    def _processar(self):
+        self._handle = None
+        agora = self._agora()
+        while self.tique < agora and len(self):
+            self.tique += 1
+            indice = self.tique & MASCARA_NIVEL
+            nivel = 1
+            while indice == 0 and nivel < NIVEIS:
+                indice = self._derramar(nivel)
+                nivel += 1
+            # Retira um por vez, pois um callback pode cancelar ou reagendar
+            # outro temporizador que expira neste mesmo tique
+            slot = self._niveis[0][self.tique & MASCARA_NIVEL]
+            while slot:
+                temporizador = slot.pop()
+                temporizador._slot = None
+                self._quantidade[0] -= 1
+                try:
+                    temporizador.callback()
+                except:
+                    traceback.print_exc()
+        if not len(self):
+            self.tique = agora
+        self._armar()
@@ -0,0 +1,737 @@
+#!/usr/bin/env python3
+# Verificações automáticas das partes da pilha que foram otimizadas.
+#
+# Cada verificação compara uma implementação otimizada com uma versão de
+# referência simples usando entradas aleatórias, mede se a roda de
+# temporização dispara os temporizadores na hora certa, ou faz o papel de um
+# cliente diante do Servidor do tcp.py e confere os segmentos que ele manda.
+# Não usa a camada física.
+#
+# Uso: ./verificacoes.py [semente]
+
+import asyncio
+import random
+import sys
+import time
+import tcputils
+import tcp
+import checksum
+import slip
+from cabecalhos import Pacote, PAR
+from temporizador import RodaTemporizacao
+from tcp import FilaRemontagem
+from tcputils import FLAGS_SYN, FLAGS_ACK, MSS
+from servidor import DivisorLinhas, TAMANHO_MAXIMO_LINHA
+
+SLIP_END = 0xc0
+SLIP_ESC = 0xdb
+SLIP_ESC_END = 0xdc
+SLIP_ESC_ESC = 0xdd
+
+
+def bytes_aleatorios(rnd, tamanho, alfabeto=None):
+    if alfabeto is None:
+        return bytes(rnd.getrandbits(8) for _ in range(tamanho))
+    return bytes(rnd.choice(alfabeto) for _ in range(tamanho))
+
+
+# Referências do SLIP: as versões originais, byte a byte
+
+def slip_codificar_referencia(datagrama):
+    quadro = bytearray([SLIP_END])
+    for byte in datagrama:
+        if byte == SLIP_END:
+            quadro += bytes([SLIP_ESC, SLIP_ESC_END])
+        elif byte == SLIP_ESC:
+            quadro += bytes([SLIP_ESC, SLIP_ESC_ESC])
+        else:
+            quadro.append(byte)
+    quadro.append(SLIP_END)
+    return bytes(quadro)
+
+
+def slip_decodificar_referencia(dados):
+    datagramas = []
+    quadro = bytearray()
+    for byte in dados:
+        if byte != SLIP_END:
+            quadro.append(byte)
+            continue
+        datagrama = bytearray()
+        i = 0
+        while i < len(quadro):
+            if quadro[i] == SLIP_ESC and i + 1 < len(quadro) and \
+                    quadro[i+1] in (SLIP_ESC_END, SLIP_ESC_ESC):
+                datagrama.append(SLIP_END if quadro[i+1] == SLIP_ESC_END else SLIP_ESC)
+                i += 2
+            else:
+                datagrama.append(quadro[i])
+                i += 1
+        if datagrama:
+            datagramas.append(bytes(datagrama))
+        quadro = bytearray()
+    return datagramas
+
+
+class LinhaFalsa:
+    def __init__(self, sincrona):
+        self.envio_sincrono = sincrona
+        self.callback = None
+        self.enviados = []
+
+    def registrar_recebedor(self, callback):
+        self.callback = callback
+
+    def enviar(self, dados):
+        self.enviados.append(bytes(dados))
+
+
+def verificar_slip_codificacao(rnd):
+    # Bytes "perigosos" aparecem com frequência
+    alfabeto = [SLIP_END, SLIP_ESC, SLIP_ESC_END, SLIP_ESC_ESC, 0x00, 0x41]
+    for sincrona in (False, True):
+        linha = LinhaFalsa(sincrona)
+        enlace = slip.Enlace(linha)
+        for _ in range(300):
+            if rnd.random() < 0.5:
+                datagrama = bytes_aleatorios(rnd, rnd.randint(1, 600), alfabeto)
+            else:
+                datagrama = bytes_aleatorios(rnd, rnd.randint(1, 600))
+            esperado = slip_codificar_referencia(datagrama)
+            enlace.enviar(datagrama)
+            enlace.enviar_pacote(Pacote.de(datagrama))
+            # Pacote sem folga: enviar_pacote precisa realocar
+            enlace.enviar_pacote(Pacote.de(datagrama, 0, 0))
+            assert linha.enviados == [esperado] * 3, datagrama
+            linha.enviados.clear()
+    print('slip: codificação igual à original')
+
+
+def verificar_slip_decodificacao(rnd):
+    # Inclui escapes mal formados e ENDs repetidos nos dados recebidos
+    alfabeto = [SLIP_END, SLIP_ESC, SLIP_ESC_END, SLIP_ESC_ESC, 0x00, 0x41]
+    recebidos = []
+    linha = LinhaFalsa(False)
+    enlace = slip.Enlace(linha)
+    enlace.registrar_recebedor(lambda datagrama: recebidos.append(bytes(datagrama)))
+    for _ in range(100):
+        fluxo = b''.join(slip_codificar_referencia(bytes_aleatorios(rnd, rnd.randint(1, 300)))
+                         for _ in range(rnd.randint(1, 5)))
+        fluxo += bytes_aleatorios(rnd, rnd.randint(0, 50), alfabeto) + bytes([SLIP_END])
+        recebidos.clear()
+        # Os dados chegam da linha em pedaços de tamanho arbitrário
+        i = 0
+        while i < len(fluxo):
+            pedaco = rnd.randint(1, 200)
+            linha.callback(fluxo[i:i+pedaco])
+            i += pedaco
+        assert recebidos == slip_decodificar_referencia(fluxo), fluxo
+    print('slip: decodificação igual à original')
+
+
+def verificar_checksum(rnd):
+    for _ in range(2000):
+        dados = bytes_aleatorios(rnd, rnd.randint(0, 1600))
+        src = '10.%d.%d.%d' % (rnd.randrange(256), rnd.randrange(256), rnd.randrange(256))
+        dst = '192.168.%d.%d' % (rnd.randrange(256), rnd.randrange(256))
+        assert checksum.calc_checksum(dados) == tcputils.calc_checksum(dados)
+        esperado = tcputils.calc_checksum(dados, src, dst)
+        assert checksum.calc_checksum(dados, src, dst) == esperado
+        assert checksum.calc_checksum(dados, checksum.endereco_int(src),
+                                      checksum.endereco_int(dst)) == esperado
+        if len(dados) >= 20:
+            assert checksum.fix_checksum(dados, src, dst) == \
+                tcputils.fix_checksum(dados, src, dst)
+        if len(dados) >= 2 and len(dados) % 2 == 0:
+            # Atualização incremental (RFC 1624) de uma palavra
+            i = rnd.randrange(0, len(dados), 2)
+            novo = rnd.getrandbits(16)
+            alterados = dados[:i] + novo.to_bytes(2, 'big') + dados[i+2:]
+            antigo = int.from_bytes(dados[i:i+2], 'big')
+            atualizado = checksum.atualizar_checksum(checksum.calc_checksum(dados), antigo, novo)
+            # 0x0000 e 0xffff são equivalentes em complemento de um
+            assert atualizado % 0xffff == checksum.calc_checksum(alterados) % 0xffff
+    print('checksum: igual ao de tcputils')
+
+
+def verificar_remontagem(rnd):
+    for _ in range(300):
+        inicio = rnd.randrange(2**31)
+        fluxo = bytes_aleatorios(rnd, rnd.randint(1, 5000))
+        # Segmentos com sobreposições e duplicatas, entregues fora de ordem
+        segmentos = []
+        pos = 0
+        while pos < len(fluxo):
+            tamanho = rnd.randint(1, 500)
+            segmentos.append((pos, fluxo[pos:pos+tamanho]))
+            if rnd.random() < 0.2:
+                segmentos.append((pos, fluxo[pos:pos+tamanho]))
+            if rnd.random() < 0.2 and pos > 0:
+                recuo = rnd.randint(1, pos)
+                segmentos.append((pos - recuo, fluxo[pos-recuo:pos+tamanho]))
+            pos += tamanho
+        rnd.shuffle(segmentos)
+        fila = FilaRemontagem(limite=sum(len(dados) for _, dados in segmentos))
+        proximo = inicio
+        recebido = []
+        for pos, dados in segmentos:
+            seq = inicio + pos
+            if seq > proximo:
+                assert fila.inserir(seq, dados)
+                # Os blocos SACK são os trechos contíguos guardados, e o
+                # primeiro contém o último segmento inserido
+                blocos = fila.blocos(maximo=len(fila))
+                assert blocos[0][0] <= seq < blocos[0][1]
+                ordenados = sorted(blocos)
+                assert all(a[1] < b[0] for a, b in zip(ordenados, ordenados[1:]))
+                continue
+            if seq + len(dados) > proximo:
+                recebido.append(dados[proximo - seq:])
+                proximo = seq + len(dados)
+            partes, proximo = fila.retirar_contiguos(proximo)
+            recebido += partes
+        assert b''.join(recebido) == fluxo and not fila and fila.bytes == 0
+    print('remontagem: fluxo reconstruído')
+
+
+def dividir_linhas_referencia(fluxo):
+    """
+    Divisão ingênua do fluxo inteiro de uma vez: linhas terminadas em \\n,
+    sem o \\r final, truncadas no limite do IRC.
+    """
+    maximo = TAMANHO_MAXIMO_LINHA - 2
+    *linhas, _ = fluxo.split(b'\n')
+    resultado = []
+    for linha in linhas:
+        if linha.endswith(b'\r'):
+            linha = linha[:-1]
+        resultado.append(linha[:maximo])
+    return resultado
+
+
+def verificar_linhas(rnd):
+    for _ in range(500):
+        linhas = []
+        for _ in range(rnd.randint(1, 30)):
+            tamanho = rnd.choice([0, 1, 10, 100, 509, 510, 511, 512, 513, 2000])
+            linha = bytes_aleatorios(rnd, tamanho, b'abc \r')
+            linhas.append(linha + rnd.choice([b'\r\n', b'\n']))
+        fluxo = b''.join(linhas)
+        divisor = DivisorLinhas()
+        obtidas = []
+        i = 0
+        while i < len(fluxo):
+            pedaco = rnd.randint(1, 700)
+            dados = fluxo[i:i+pedaco]
+            if rnd.random() < 0.3:
+                dados = memoryview(dados)
+            obtidas += divisor.alimentar(dados)
+            i += pedaco
+        assert obtidas == dividir_linhas_referencia(fluxo), fluxo
+        assert divisor.buffer is None
+    print('linhas: CRLF, LF sozinho e limite de %d bytes' % TAMANHO_MAXIMO_LINHA)
+
+
+async def verificar_roda(rnd):
+    roda = RodaTemporizacao()
+    loop = asyncio.get_running_loop()
+    disparos = {}
+    prazos = {}
+    temporizadores = []
+
+    def criar(i):
+        def disparar():
+            disparos.setdefault(i, []).append(loop.time())
+        return roda.criar(disparar)
+
+    for i in range(2000):
+        temporizador = criar(i)
+        temporizadores.append(temporizador)
+        # Atrasos que atravessam a fronteira entre os níveis 0 e 1
+        atraso = rnd.uniform(0, 1.5)
+        temporizador.agendar(atraso)
+        prazos[i] = loop.time() + atraso
+    cancelados = set(rnd.sample(range(len(temporizadores)), 300))
+    for i in cancelados:
+        temporizadores[i].cancelar()
+    # Alguns são reagendados depois de um tempo, como faz o RTO
+    await asyncio.sleep(0.2)
+    for i in rnd.sample(sorted(set(range(len(temporizadores))) - cancelados), 300):
+        if not temporizadores[i].ativo:
+            continue
+        atraso = rnd.uniform(0, 1.0)
+        temporizadores[i].agendar(atraso)
+        prazos[i] = loop.time() + atraso
+    await asyncio.sleep(1.8)
+
+    erros = []
+    for i, temporizador in enumerate(temporizadores):
+        if i in cancelados:
+            assert i not in disparos, 'temporizador cancelado disparou'
+            continue
+        assert len(disparos.get(i, ())) == 1, 'temporizador %d disparou %r' % (i, disparos.get(i))
+        erros.append(disparos[i][0] - prazos[i])
+    assert not len(roda)
+    # Nunca dispara antes do prazo (a menos da resolução do relógio do
+    # asyncio) e só se atrasa pela granularidade e pela carga do laço de
+    # eventos
+    assert min(erros) >= -0.002, min(erros)
+    assert max(erros) <= 0.1, max(erros)
+    print('roda: %d disparos, erro entre %+.3f e %+.3f s' % (len(erros), min(erros), max(erros)))
+
+
+# Transmissor TCP: o Servidor conversa com um cliente falso, sem IP nem SLIP
+
+ENDERECO_CLIENTE = 0x0a000001
+ENDERECO_SERVIDOR = 0x0a000002
+PORTA = 7000
+
+
+class RedeFalsa:
+    ignore_checksum = False
+
+    def __init__(self):
+        self.callback = None
+        self.enviados = []
+
+    def registrar_recebedor(self, callback):
+        self.callback = callback
+
+    def enviar(self, segmento, dest_addr):
+        assert dest_addr == ENDERECO_CLIENTE
+        assert checksum.calc_checksum(segmento, ENDERECO_SERVIDOR, ENDERECO_CLIENTE) == 0
+        self.enviados.append(bytes(segmento))
+
+    def enviar_pacote(self, segmento, dest_addr):
+        self.enviar(bytes(segmento), dest_addr)
+
+
+class Segmento:
+    """
+    Segmento mandado pelo servidor, já lido.
+    """
+    def __init__(self, dados):
+        _, _, self.seq, self.ack, flags, self.janela, _, _ = tcputils.read_header(dados)
+        tamanho_cabecalho = 4*(flags >> 12)
+        self.flags = flags & 0x1ff
+        self.opcoes = tcp.ler_opcoes(dados[20:tamanho_cabecalho])
+        self.dados = dados[tamanho_cabecalho:]
+
+
+class ClienteFalso:
+    def __init__(self, rede, porta=5000):
+        self.rede = rede
+        self.porta = porta
+        self.seq = 1000
+        self.proximo = None
+        self.synack = None
+
+    def mandar(self, seq, ack, flags, dados=b'', opcoes=b'', janela=0xffff):
+        cabecalho = tcp.montar_cabecalho(self.porta, PORTA, seq, ack, flags,
+                                         tcp.montar_opcoes(opcoes), janela)
+        segmento = checksum.fix_checksum(bytes(cabecalho) + dados,
+                                         ENDERECO_CLIENTE, ENDERECO_SERVIDOR)
+        self.rede.callback(ENDERECO_CLIENTE, ENDERECO_SERVIDOR, segmento)
+
+    def enviar(self, dados, janela=0xffff):
+        self.mandar(self.seq, self.proximo, FLAGS_ACK, dados, janela=janela)
+        self.seq += len(dados)
+
+    def receber(self):
+        segmentos = [Segmento(dados) for dados in self.rede.enviados]
+        self.rede.enviados.clear()
+        return segmentos
+
+    def conectar(self, opcoes=b'', janela=0xffff):
+        self.mandar(self.seq, 0, FLAGS_SYN, opcoes=opcoes, janela=janela)
+        synack, = self.receber()
+        assert synack.flags == FLAGS_SYN | FLAGS_ACK and synack.ack == self.seq + 1
+        self.seq += 1
+        self.proximo = synack.seq + 1
+        self.mandar(self.seq, self.proximo, FLAGS_ACK, janela=janela)
+        self.synack = synack
+
+
+def abrir_conexao(opcoes=b'', janela=0xffff, **kwargs):
+    """
+    Cria um Servidor e faz o handshake com um cliente falso. Devolve o
+    cliente, a Conexao e o buffer com o que a aplicação recebeu.
+    """
+    rede = RedeFalsa()
+    servidor = tcp.Servidor(rede, PORTA, **kwargs)
+    conexoes = []
+    servidor.registrar_monitor_de_conexoes_aceitas(conexoes.append)
+    cliente = ClienteFalso(rede)
+    cliente.conectar(opcoes, janela)
+    conexao, = conexoes
+    recebido = bytearray()
+    conexao.registrar_recebedor(lambda conexao, dados: recebido.extend(dados))
+    return cliente, conexao, recebido
+
+
+def blocos_contiguos(guardados):
+    """
+    Junta os trechos {seq: dados} guardados fora de ordem em blocos
+    [(inicio, fim), ...] ordenados.
+    """
+    blocos = []
+    for seq in sorted(guardados):
+        fim = seq + len(guardados[seq])
+        if blocos and blocos[-1][1] == seq:
+            blocos[-1] = (blocos[-1][0], fim)
+        else:
+            blocos.append((seq, fim))
+    return blocos
+
+
+async def verificar_recuperacao_sack(rnd):
+    for _ in range(200):
+        cliente, conexao, _ = abrir_conexao(bytes([tcp.TCPOPT_SACK_PERMITTED, 2]))
+        assert conexao.sack_permitido
+        # Janela grande o bastante para mandar tudo de uma vez
+        n = rnd.randint(6, 30)
+        conexao.cc.cwnd = conexao.cc.ssthresh = float(n * conexao.mss)
+        fluxo = bytes_aleatorios(rnd, n * conexao.mss)
+        conexao.enviar(fluxo)
+        # Os 3 últimos segmentos sempre chegam e geram os ACKs duplicados
+        perdidos = set(rnd.sample(range(n - 3), rnd.randint(1, min(8, n - 3))))
+        base = cliente.proximo
+        perdidos = {base + i * conexao.mss for i in perdidos}
+
+        # Receptor com SACK: ACK a cada segmento, com o bloco do último
+        # segmento recebido primeiro
+        vistos = set()
+        retransmitidos = []
+        guardados = {}
+        recebido = bytearray()
+        fila = []
+        while True:
+            fila += cliente.receber()
+            if not fila:
+                break
+            segmento = fila.pop(0)
+            if not segmento.dados:
+                continue
+            if segmento.seq in vistos:
+                retransmitidos.append(segmento.seq)
+            else:
+                vistos.add(segmento.seq)
+                if segmento.seq in perdidos:
+                    continue
+            if segmento.seq >= cliente.proximo:
+                guardados[segmento.seq] = segmento.dados
+            while cliente.proximo in guardados:
+                dados = guardados.pop(cliente.proximo)
+                recebido += dados
+                cliente.proximo += len(dados)
+            blocos = blocos_contiguos(guardados)
+            blocos.sort(key=lambda bloco: not (bloco[0] <= segmento.seq < bloco[1]))
+            opcoes = b''
+            if blocos:
+                opcoes = tcp.opcao_sack(blocos[:tcp.MAX_BLOCOS_SACK])
+            em_recuperacao = conexao.recuperacao_ate is not None
+            cliente.mandar(cliente.seq, cliente.proximo, FLAGS_ACK, opcoes=opcoes)
+            # Ao entrar em recuperação, a primeira lacuna sai de qualquer
+            # jeito; as demais só se couberem na janela sem a inflação dos
+            # ACKs duplicados (RFC 6675)
+            extras = len(cliente.rede.enviados)
+            if not em_recuperacao and conexao.recuperacao_ate is not None:
+                extras -= 1
+            if extras > 0:
+                assert conexao._pipe() <= min(conexao.cc.cwnd, conexao.cc.ssthresh)
+
+        # Tudo foi recuperado sem esperar o RTO, e só o que se perdeu foi
+        # retransmitido, uma vez
+        assert bytes(recebido) == fluxo
+        assert sorted(retransmitidos) == sorted(perdidos), (retransmitidos, perdidos)
+        assert not conexao.unacked_segments and conexao.recuperacao_ate is None
+        assert conexao.cc.cwnd <= conexao.cc.ssthresh
+    print('sack: só as lacunas são retransmitidas, dentro da janela')
+
+
+async def verificar_ack_atrasado(rnd):
+    for _ in range(10):
+        cliente, conexao, recebido = abrir_conexao()
+        inicio = cliente.seq
+        # Em ordem: um ACK a cada dois segmentos, e o de um segmento sozinho
+        # só depois de ATRASO_ACK
+        n = rnd.randint(1, 7)
+        for i in range(n):
+            cliente.enviar(bytes_aleatorios(rnd, rnd.randint(1, MSS)))
+            acks = cliente.receber()
+            if i % 2 == 0:
+                assert not acks
+            else:
+                ack, = acks
+                assert ack.ack == cliente.seq and not ack.dados
+        await asyncio.sleep(tcp.ATRASO_ACK + 0.03)
+        acks = cliente.receber()
+        assert len(acks) == n % 2 and all(ack.ack == cliente.seq for ack in acks)
+
+        # Fora de ordem: ACK duplicado imediato; a lacuna preenchida também
+        # é reconhecida na hora
+        lacuna = bytes_aleatorios(rnd, rnd.randint(1, MSS))
+        depois = bytes_aleatorios(rnd, rnd.randint(1, MSS))
+        cliente.mandar(cliente.seq + len(lacuna), cliente.proximo, FLAGS_ACK, depois)
+        ack, = cliente.receber()
+        assert ack.ack == cliente.seq
+        cliente.enviar(lacuna)
+        cliente.seq += len(depois)
+        ack, = cliente.receber()
+        assert ack.ack == cliente.seq
+        assert len(recebido) == cliente.seq - inicio
+
+        # Se a aplicação responde dentro do callback, o ACK vai de carona
+        # nos dados e nenhum ACK puro sai depois
+        conexao.registrar_recebedor(lambda conexao, dados: conexao.enviar(dados))
+        dados = bytes_aleatorios(rnd, rnd.randint(1, MSS))
+        cliente.enviar(dados)
+        resposta, = cliente.receber()
+        assert resposta.dados == dados and resposta.ack == cliente.seq
+        await asyncio.sleep(tcp.ATRASO_ACK + 0.03)
+        assert not cliente.receber()
+    print('ack atrasado: um ACK a cada dois segmentos ou depois de %g s' % tcp.ATRASO_ACK)
+
+
+async def verificar_agrupamento(rnd):
+    for _ in range(100):
+        cliente, conexao, _ = abrir_conexao()
+        conexao.cc.cwnd = float(20 * conexao.mss)
+        escrito = bytearray()
+        recebido = bytearray()
+
+        def ler_e_reconhecer(reconhecer):
+            for segmento in cliente.receber():
+                assert segmento.seq == cliente.proximo
+                recebido.extend(segmento.dados)
+                cliente.proximo += len(segmento.dados)
+            if reconhecer:
+                cliente.mandar(cliente.seq, cliente.proximo, FLAGS_ACK)
+
+        # Nagle: enquanto houver dados em voo, no máximo um segmento menor
+        # que o MSS pode estar pendente
+        conexao.definir_nagle(True)
+        for _ in range(rnd.randint(1, 5)):
+            for _ in range(rnd.randint(1, 40)):
+                dados = bytes_aleatorios(rnd, rnd.randint(1, 300))
+                escrito += dados
+                conexao.enviar(dados)
+                pequenos = [p for p in conexao.unacked_segments
+                            if p.seq_fim - p.seq < conexao.mss]
+                assert len(pequenos) <= 1
+                ler_e_reconhecer(False)
+            while conexao.unacked_segments or conexao.send_buffer:
+                ler_e_reconhecer(True)
+        assert recebido == escrito
+        conexao.definir_nagle(False)
+
+        # tampar: só saem segmentos cheios até destampar
+        conexao.tampar()
+        for _ in range(rnd.randint(1, 40)):
+            dados = bytes_aleatorios(rnd, rnd.randint(1, 700))
+            escrito += dados
+            conexao.enviar(dados)
+        cheios = cliente.receber()
+        assert all(len(segmento.dados) == conexao.mss for segmento in cheios)
+        conexao.destampar()
+        resto = cliente.receber()
+        assert len(resto) <= 1 and all(len(segmento.dados) < conexao.mss for segmento in resto)
+        recebido += b''.join(segmento.dados for segmento in cheios + resto)
+        assert recebido == escrito
+    print('agrupamento: Nagle e tampar/destampar')
+
+
+async def verificar_janela(rnd):
+    for _ in range(10):
+        escala = rnd.choice([None, 0, 3, 7])
+        opcoes = b'' if escala is None else bytes([tcp.TCPOPT_WSCALE, 3, escala])
+        buffer_recepcao = rnd.choice([4 * MSS, 8 * MSS, 100000])
+        janela = rnd.randint(1, 8 * MSS >> (escala or 0))
+        cliente, conexao, recebido = abrir_conexao(opcoes, janela,
+                                                   buffer_recepcao=buffer_recepcao)
+        escala = escala or 0
+        escala_servidor = 0
+        if tcp.TCPOPT_WSCALE in cliente.synack.opcoes:
+            escala_servidor = cliente.synack.opcoes[tcp.TCPOPT_WSCALE][0]
+        conexao.cc.cwnd = float(100 * conexao.mss)
+
+        # Transmissor: nunca passa da borda da janela anunciada pelo
+        # cliente, e sonda a janela zero até ela abrir
+        fluxo = bytes_aleatorios(rnd, rnd.randint(1, 60000))
+        conexao.enviar(fluxo)
+        # A janela do ACK do handshake já vem escalada
+        borda = cliente.proximo + (janela << escala)
+        obtido = bytearray()
+        zerada = False
+        while True:
+            segmentos = cliente.receber()
+            for segmento in segmentos:
+                assert segmento.seq == cliente.proximo
+                assert segmento.seq + len(segmento.dados) <= borda
+                obtido += segmento.dados
+                cliente.proximo += len(segmento.dados)
+            if not segmentos and not conexao.send_buffer:
+                break
+            if not zerada and conexao.send_buffer:
+                cliente.mandar(cliente.seq, cliente.proximo, FLAGS_ACK, janela=0)
+                assert not cliente.receber()
+                await asyncio.sleep(conexao.intervalo_persistencia + 0.05)
+                sonda, = cliente.receber()
+                assert not sonda.dados and sonda.seq == conexao.srv_seq - 1
+                zerada = True
+            janela = rnd.randint(1, 0xffff >> max(0, 7 - escala))
+            cliente.mandar(cliente.seq, cliente.proximo, FLAGS_ACK, janela=janela)
+            borda = cliente.proximo + (janela << escala)
+        assert obtido == fluxo
+
+        # Receptor: com a leitura pausada, aceita só o que cabe no buffer e
+        # anuncia a janela fechando; ao retomar, avisa que ela reabriu
+        conexao.pausar_leitura()
+        inicio = cliente.seq
+        dados = bytes_aleatorios(rnd, buffer_recepcao + rnd.randint(1, 3 * MSS))
+        for i in range(0, len(dados), MSS):
+            cliente.mandar(inicio + i, cliente.proximo, FLAGS_ACK, dados[i:i+MSS])
+        await asyncio.sleep(tcp.ATRASO_ACK + 0.03)
+        ultimo = cliente.receber()[-1]
+        assert ultimo.ack == inicio + buffer_recepcao and ultimo.janela == 0
+        assert not recebido
+        conexao.retomar_leitura()
+        assert recebido == dados[:buffer_recepcao]
+        ultimo, = cliente.receber()
+        assert ultimo.ack == inicio + buffer_recepcao
+        assert ultimo.janela << escala_servidor >= min(buffer_recepcao, MSS)
+    print('janela: borda do cliente respeitada, sondas e janela anunciada')
+
+
+def ler_ts(segmento):
+    return PAR.unpack(segmento.opcoes[tcp.TCPOPT_TIMESTAMP])
+
+
+async def verificar_timestamps(rnd):
+    for _ in range(5):
+        tsval = rnd.randrange(2**32)
+        cliente, conexao, _ = abrir_conexao(tcp.opcao_ts(tsval, 0))
+        assert ler_ts(cliente.synack)[1] == tsval
+        assert conexao.timestamps and conexao.mss == MSS - tcp.TAMANHO_OPCAO_TS
+
+        # A primeira amostra de RTT vem do TSecr do ACK
+        atraso = rnd.uniform(0.02, 0.08)
+        conexao.enviar(bytes_aleatorios(rnd, 100))
+        segmento, = cliente.receber()
+        await asyncio.sleep(atraso)
+        cliente.proximo += len(segmento.dados)
+        cliente.mandar(cliente.seq, cliente.proximo, FLAGS_ACK,
+                       opcoes=tcp.opcao_ts(tsval, ler_ts(segmento)[0]))
+        assert atraso - 0.002 <= conexao.EstimatedRTT <= atraso + 0.03, (atraso, conexao.EstimatedRTT)
+
+        # A retransmissão leva um TSval novo (com o checksum refeito), e o
+        # eco dele dá uma amostra do RTT de verdade, não do RTO
+        conexao.enviar(bytes_aleatorios(rnd, 100))
+        original, = cliente.receber()
+        await asyncio.sleep(conexao.TimeoutInterval + 0.05)
+        retransmitido, = cliente.receber()
+        assert retransmitido.seq == original.seq and retransmitido.dados == original.dados
+        assert (ler_ts(retransmitido)[0] - ler_ts(original)[0]) & 0xffffffff >= 100
+        cliente.proximo += len(retransmitido.dados)
+        cliente.mandar(cliente.seq, cliente.proximo, FLAGS_ACK,
+                       opcoes=tcp.opcao_ts(tsval, ler_ts(retransmitido)[0]))
+        assert conexao.EstimatedRTT <= atraso + 0.03
+
+        # Cada segmento ecoa o TSval mais recente do cliente, nunca um mais
+        # antigo; os dados cabem no MSS descontada a opção
+        conexao.registrar_recebedor(lambda conexao, dados: conexao.enviar(dados))
+        tsval_srv = ler_ts(retransmitido)[0]
+        for _ in range(50):
+            antigo = rnd.random() < 0.2
+            if antigo:
+                enviado = (tsval - rnd.randint(1, 1000)) & 0xffffffff
+            else:
+                tsval = enviado = (tsval + rnd.randint(0, 1000)) & 0xffffffff
+            dados = bytes_aleatorios(rnd, rnd.randint(1, MSS))
+            cliente.mandar(cliente.seq, cliente.proximo, FLAGS_ACK, dados,
+                           opcoes=tcp.opcao_ts(enviado, tsval_srv))
+            cliente.seq += len(dados)
+            respostas = cliente.receber()
+            assert b''.join(resposta.dados for resposta in respostas) == dados
+            for resposta in respostas:
+                assert len(resposta.dados) <= conexao.mss
+                novo_tsval_srv, tsecr = ler_ts(resposta)
+                assert tsecr == tsval
+                assert (novo_tsval_srv - tsval_srv) & 0xffffffff < 0x80000000
+                tsval_srv = novo_tsval_srv
+                cliente.proximo += len(resposta.dados)
+            cliente.mandar(cliente.seq, cliente.proximo, FLAGS_ACK,
+                           opcoes=tcp.opcao_ts(tsval, tsval_srv))
+    print('timestamps: eco do TSval, amostras de RTT e retransmissões')
+
+
+async def verificar_semiabertas(rnd):
+    for _ in range(20):
+        max_conexoes = rnd.choice([None, rnd.randint(1, 5)])
+        rede = RedeFalsa()
+        servidor = tcp.Servidor(rede, PORTA, max_conexoes=max_conexoes)
+        limite = tcp.MAX_SEMIABERTAS if max_conexoes is None else max_conexoes
+
+        # Enxurrada de SYNs: só as semiabertas mais recentes (ou só até o
+        # limite de conexões) ficam na tabela, e nenhuma Conexao é criada
+        clientes = []
+        for porta in range(1024, 1024 + limite + rnd.randint(1, 50)):
+            cliente = ClienteFalso(rede, porta)
+            cliente.seq = rnd.randrange(2**32 - 1)
+            cliente.mandar(cliente.seq, 0, FLAGS_SYN)
+            synacks = cliente.receber()
+            assert len(synacks) == (max_conexoes is None or len(clientes) < max_conexoes)
+            if synacks:
+                cliente.synack = synacks[0]
+                clientes.append(cliente)
+        assert len(servidor.semiabertas) == limite and not servidor.conexoes
+
+        # Um SYN repetido recebe o mesmo SYN-ACK
+        cliente = rnd.choice(clientes[-limite:])
+        cliente.mandar(cliente.seq, 0, FLAGS_SYN)
+        synack, = cliente.receber()
+        assert synack.seq == cliente.synack.seq
+
+        # O ACK final só abre a conexão se a semiaberta ainda estiver na
+        # tabela e se reconhecer o SYN-ACK
+        for cliente in clientes:
+            cliente.mandar(cliente.seq + 1, cliente.synack.seq, FLAGS_ACK)
+            cliente.mandar(cliente.seq + 1, cliente.synack.seq + 1, FLAGS_ACK)
+        assert len(servidor.conexoes) == limite and not servidor.semiabertas
+        for cliente in clientes[:-limite]:
+            assert (ENDERECO_CLIENTE, cliente.porta, ENDERECO_SERVIDOR, PORTA) \
+                not in servidor.conexoes
+
+        # Com o limite de conexões, a tabela cheia recusa novos SYNs
+        cliente = ClienteFalso(rede, 80)
+        cliente.mandar(cliente.seq, 0, FLAGS_SYN)
+        assert bool(cliente.receber()) == (max_conexoes is None)
+
+        # Semiabertas antigas são descartadas pela coleta
+        for semiaberta in servidor.semiabertas.values():
+            semiaberta.instante -= tcp.TEMPO_SEMIABERTA + 1
+        servidor._coletar()
+        assert not servidor.semiabertas
+    print('semiabertas: tabela limitada, ACK final e coleta')
+
+
+def main():
+    semente = int(sys.argv[1]) if len(sys.argv) > 1 else int(time.time())
+    print('semente', semente)
+    rnd = random.Random(semente)
+    verificar_checksum(rnd)
+    verificar_slip_codificacao(rnd)
+    verificar_slip_decodificacao(rnd)
+    verificar_remontagem(rnd)
+    verificar_linhas(rnd)
+    asyncio.run(verificar_roda(rnd))
+    asyncio.run(verificar_recuperacao_sack(rnd))
+    asyncio.run(verificar_ack_atrasado(rnd))
+    asyncio.run(verificar_agrupamento(rnd))
+    asyncio.run(verificar_janela(rnd))
+    asyncio.run(verificar_timestamps(rnd))
+    asyncio.run(verificar_semiabertas(rnd))
+
+
+if __name__ == '__main__':
+    main()